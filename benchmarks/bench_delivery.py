@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+"""
+Load test of the whole notification path, from OctoPrint event to SMTP server.
+
+Drives an OctoTextPlugin with synthetic events (uploads, print start/done, progress, errors) against an
+in-process SMTP server and webcam (see fake_servers.py) and reports the end-to-end latency percentiles,
+throughput and memory per notification. Needs OctoPrint installed (it imports the plugin as OctoPrint
+would) and openssl for the fake server's STARTTLS certificate. The plugin doesn't verify mail server
+certificates (see smtp_tls_context), so the self-signed one works with both delivery engines. The run fails
+when nothing is delivered.
+
+    python benchmarks/bench_delivery.py --events 200 --rate 20
+    python benchmarks/bench_delivery.py --smtp-latency 1.5 --send-failure-rate 0.1 --recipients 4
+    python benchmarks/bench_delivery.py --throttle 30 --engine asyncio
+"""
+import argparse
+import itertools
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import octoprint.events
+
+import octoprint_OctoText
+from fake_servers import FakeSMTPServer, FakeSnapshotServer, make_certificate
+from octoprint_OctoText import OctoTextPlugin
+from octoprint_OctoText.dedup import DEFAULT_DEDUP_WINDOWS
+
+# share of each kind of event in the synthetic load
+EVENT_MIX = {"progress": 6, "start": 1, "done": 1, "upload": 1, "error": 1}
+
+
+class BenchSettings:
+    """
+    The parts of OctoPrint's PluginSettings the plugin reads, backed by plain dicts.
+    """
+
+    def __init__(self, defaults, overrides, global_values):
+        self._values = dict(defaults)
+        self._values.update(overrides)
+        self._global = global_values
+
+    def get(self, path, **kwargs):
+        return self._values.get(path[0])
+
+    def global_get(self, path, **kwargs):
+        return self._global.get(tuple(path))
+
+    def global_get_boolean(self, path, **kwargs):
+        return bool(self._global.get(tuple(path)))
+
+
+class BenchPrinter:
+    def get_current_data(self):
+        return {"progress": {"printTime": 600, "printTimeLeft": 3000}}
+
+
+def make_plugin(args, smtp, webcam, data_folder):
+    plugin = OctoTextPlugin()
+    plugin._identifier = "OctoText"
+    plugin._plugin_name = "OctoText"
+    plugin._plugin_version = "benchmark"
+    plugin._basefolder = os.path.dirname(octoprint_OctoText.__file__)
+    plugin._data_folder = data_folder
+    plugin._logger = logging.getLogger("octoprint.plugins.OctoText")
+    plugin._printer = BenchPrinter()
+
+    recipients = [
+        {"address": f"5550{n:03d}@carrier{n}.example"} for n in range(args.recipients)
+    ]
+    overrides = {
+        "smtp_name": "127.0.0.1",
+        "smtp_port": smtp.port,
+        "use_ssl": False,
+        "username": "bench",
+        "servername": "example.com",
+        "server_pass": "secret",
+        "recipients": recipients,
+        "en_upload": True,
+        "en_printstart": True,
+        "en_printend": True,
+        "en_error": True,
+        "en_progress": True,
+        "en_progress_time": False,
+        "en_webcam": not args.no_webcam,
+        "progress_interval": 10,
+        "rate_per_minute": args.rate_per_minute,
+        "retry_delay": args.retry_delay,
+        "retry_max_delay": args.retry_delay * 8,
+        "en_digest": not args.no_digest,
+        "en_spool": not args.no_spool,
+        "send_workers": args.workers,
+        "delivery_engine": args.engine,
+    }
+    if not args.dedup:
+        # every synthetic event is different, but the errors would all count as repeats
+        overrides["dedup_windows"] = {event_class: 0 for event_class in DEFAULT_DEDUP_WINDOWS}
+    global_values = {
+        ("webcam", "snapshot"): webcam.url,
+        ("appearance", "name"): "Bench",
+    }
+    plugin._settings = BenchSettings(plugin.get_settings_defaults(), overrides, global_values)
+    plugin.initialize()
+    plugin.on_after_startup()
+    return plugin
+
+
+def fire(plugin, kind, token):
+    """
+    Send one synthetic event, token ends up in the body of the notification.
+    """
+    Events = octoprint.events.Events
+    name = f"{token}.gcode"
+    if kind == "progress":
+        plugin.on_print_progress("local", name, 50)
+    elif kind == "start":
+        plugin.on_event(
+            Events.PRINT_STARTED, {"name": name, "path": name, "origin": "local"}
+        )
+    elif kind == "done":
+        plugin.on_event(Events.PRINT_DONE, {"name": name, "time": 3600.0})
+    elif kind == "upload":
+        plugin.on_event(Events.UPLOAD, {"name": name, "path": name, "target": "local"})
+    elif kind == "error":
+        plugin.on_event(Events.ERROR, {"error": f"{token} heater decoupled"})
+
+
+def percentile(values, fraction):
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--events", type=int, default=200, help="number of events to fire")
+    parser.add_argument("--rate", type=float, default=20, help="events per second, 0 = all at once")
+    parser.add_argument("--recipients", type=int, default=1)
+    parser.add_argument("--engine", choices=("threads", "asyncio"), default="threads")
+    parser.add_argument("--workers", type=int, default=3, help="send_workers for --engine threads")
+    parser.add_argument("--smtp-latency", type=float, default=0.05, help="seconds per message")
+    parser.add_argument("--connect-failure-rate", type=float, default=0.0)
+    parser.add_argument("--login-failure-rate", type=float, default=0.0)
+    parser.add_argument("--send-failure-rate", type=float, default=0.0)
+    parser.add_argument("--throttle", type=int, default=0, help="SMTP server limit, messages/minute")
+    parser.add_argument("--snapshot-latency", type=float, default=0.2)
+    parser.add_argument("--no-webcam", action="store_true")
+    parser.add_argument("--no-digest", action="store_true")
+    parser.add_argument("--no-spool", action="store_true")
+    parser.add_argument("--dedup", action="store_true", help="keep the duplicate suppression on")
+    parser.add_argument("--rate-per-minute", type=float, default=0, help="plugin rate limit, 0 = off")
+    parser.add_argument("--retry-delay", type=float, default=0.5)
+    parser.add_argument("--timeout", type=float, default=120, help="seconds to wait for delivery")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.CRITICAL)
+    folder = tempfile.mkdtemp(prefix="octotext-bench-")
+    smtp = FakeSMTPServer(
+        make_certificate(folder),
+        latency=args.smtp_latency,
+        connect_failure_rate=args.connect_failure_rate,
+        login_failure_rate=args.login_failure_rate,
+        send_failure_rate=args.send_failure_rate,
+        throttle_per_minute=args.throttle,
+        seed=args.seed,
+    ).start()
+    offline = os.path.join(os.path.dirname(octoprint_OctoText.__file__), "static/img/offline.jpg")
+    with open(offline, "rb") as fp:
+        webcam = FakeSnapshotServer(fp.read(), latency=args.snapshot_latency).start()
+
+    tracemalloc.start()
+    plugin = make_plugin(args, smtp, webcam, folder)
+    memory_before = tracemalloc.get_traced_memory()[0]
+
+    rng = random.Random(args.seed)
+    kinds = list(itertools.chain.from_iterable([k] * n for k, n in EVENT_MIX.items()))
+    fired = {}
+    started = time.monotonic()
+    for n in range(args.events):
+        token = f"bench-{n}"
+        kind = rng.choice(kinds)
+        fired[token] = time.monotonic()
+        fire(plugin, kind, token)
+        if args.rate > 0:
+            time.sleep(max(0, started + (n + 1) / args.rate - time.monotonic()))
+    fired_in = time.monotonic() - started
+
+    # wait until every notification arrived, or nothing happened for a while once the queue is empty
+    expected = args.events * args.recipients
+    deadline = time.monotonic() + args.timeout
+    last_count, last_change = -1, time.monotonic()
+    memory_peak = 0
+    while time.monotonic() < deadline:
+        memory_peak = max(memory_peak, tracemalloc.get_traced_memory()[0])
+        with smtp.stats.lock:
+            count = sum(len(times) for times in smtp.stats.arrivals.values())
+        if count + plugin._queue_metrics.superseded >= expected:
+            break
+        if count != last_count:
+            last_count, last_change = count, time.monotonic()
+        elif plugin.notifyQ.qsize() == 0 and time.monotonic() - last_change > max(
+            5, args.retry_delay * 4
+        ):
+            break
+        time.sleep(0.05)
+    finished = time.monotonic()
+    memory_peak = max(memory_peak, tracemalloc.get_traced_memory()[1])
+    tracemalloc.stop()
+
+    latencies = []
+    with smtp.stats.lock:
+        for token, at in fired.items():
+            latencies.extend(arrival - at for arrival in smtp.stats.arrivals.get(token, []))
+        delivered = sum(len(times) for times in smtp.stats.arrivals.values())
+        stats = smtp.stats
+
+    metrics = plugin._metrics()
+    # notifications that were never meant to arrive, everything else missing was lost
+    superseded = metrics["superseded"]
+    suppressed = sum(metrics["dedup_suppressed"].values())
+    if expected and not delivered:
+        # latencies of nothing would look like a result, the setup is broken
+        print(
+            f"nothing was delivered: {metrics['failed']} notification(s) failed, "
+            f"retries by error {metrics['retries_by_error']}"
+        )
+        plugin.on_shutdown()
+        smtp.shutdown()
+        webcam.shutdown()
+        sys.exit(1)
+
+    elapsed = finished - started
+    print(f"events fired           {args.events} in {fired_in:.1f}s ({args.engine} engine)")
+    print(f"notifications expected {expected}, arrived {delivered} in {stats.messages} emails")
+    if superseded:
+        print(f"progress superseded    {superseded} (digest keeps only the newest)")
+    if suppressed:
+        print(f"duplicates suppressed  {suppressed}")
+    print(
+        f"given up / dropped     {metrics['failed']} sends given up, "
+        f"{metrics['queue_dropped']} dropped from the full queue"
+    )
+    print(f"smtp connections       {stats.connections}, logins {stats.logins}, refused {stats.refused}")
+    print(f"webcam requests        {webcam.requests}")
+    print(
+        "latency p50/p90/p99    {:.2f} / {:.2f} / {:.2f} s, max {:.2f} s".format(
+            percentile(latencies, 0.5),
+            percentile(latencies, 0.9),
+            percentile(latencies, 0.99),
+            max(latencies) if latencies else float("nan"),
+        )
+    )
+    print(f"throughput             {delivered / elapsed:.1f} notifications/s")
+    print(
+        f"memory                 {(memory_peak - memory_before) / max(1, args.events) / 1024:.1f} KiB "
+        f"per event at the peak, {memory_peak / 1024 / 1024:.1f} MiB traced"
+    )
+    print(f"queue metrics          retries {metrics['retries']}, coalesced {metrics['coalesced']}")
+
+    plugin.on_shutdown()
+    smtp.shutdown()
+    webcam.shutdown()
+    if delivered + superseded + suppressed < expected:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+Per-line cost of the gcode received hook (AlertWaitingForUser).
+
+Feeds a typical mix of printer output (temperature reports, "ok"s, busy messages) through the alert matcher
+and prints the time per line. Exits with status 1 if an ordinary line costs a microsecond or more. Needs
+OctoPrint installed, importing the matcher loads the plugin package.
+
+    python benchmarks/bench_gcode_filter.py
+"""
+import argparse
+import datetime
+import sys
+import timeit
+
+from octoprint_OctoText.gcode_alerts import DEFAULT_ALERTS, AlertMatcher
+
+LINES = [
+    "ok",
+    "ok T:210.0 /210.0 B:60.0 /60.0 T0:210.0 /210.0 @:64 B@:32",
+    " T:210.1 /210.0 B:60.0 /60.0 T0:210.1 /210.0 @:63 B@:30 P:0.0 A:32.4",
+    "echo:busy: processing",
+    "NORMAL MODE: Percent done: 42; print time remaining in mins: 61",
+    "X:120.00 Y:95.00 Z:0.20 E:0.00 Count X: 120.00 Y:95.00 Z:0.20",
+    "echo:enqueueing \"M24\"",
+    "wait",
+]
+
+ALERT_LINES = [
+    "echo:busy: paused for user",
+    "//action:paused filament_runout",
+    "echo:MMU: load failed",
+]
+
+
+def original_hook(line, state):
+    # what the hook did before: a datetime subtraction and a settings lookup ahead of the substring check
+    if state["last_fired"] is not None:
+        how_long = datetime.datetime.now() - state["last_fired"]
+        if how_long.seconds < int(state["settings"]["plugins"]["OctoText"]["mmu_timeout"]):
+            return line
+    if "echo:busy: paused for user" in line:
+        pass
+    return line
+
+
+def per_line_ns(func, lines, number):
+    total = timeit.timeit(lambda: [func(line) for line in lines], number=number)
+    return total / (number * len(lines)) * 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--number", type=int, default=20000)
+    parser.add_argument("--limit-ns", type=float, default=1000)
+    args = parser.parse_args()
+
+    matcher = AlertMatcher.from_settings(list(DEFAULT_ALERTS), [])
+    for line in ALERT_LINES:
+        assert matcher.match(line) is not None, line
+    for line in LINES:
+        assert matcher.match(line) is None, line
+
+    def hook(line):
+        # same shape as OctoTextPlugin.AlertWaitingForUser
+        alert = matcher.match(line)
+        if alert is not None:
+            pass
+        return line
+
+    state = {
+        "last_fired": datetime.datetime.now() - datetime.timedelta(hours=1),
+        "settings": {"plugins": {"OctoText": {"mmu_timeout": "0"}}},
+    }
+    baseline = per_line_ns(lambda line: line, LINES, args.number)
+    old = per_line_ns(lambda line: original_hook(line, state), LINES, args.number)
+    new = per_line_ns(hook, LINES, args.number)
+    matched = per_line_ns(hook, ALERT_LINES, args.number // 10 or 1)
+
+    print(f"empty loop          {baseline:8.0f} ns/line")
+    print(f"previous hook       {old:8.0f} ns/line (without OctoPrint's settings overhead)")
+    print(f"alert matcher       {new:8.0f} ns/line, {new - baseline:.0f} ns over the empty loop")
+    print(f"matching lines      {matched:8.0f} ns/line")
+
+    if new - baseline >= args.limit_ns:
+        print(f"FAIL: ordinary lines cost more than {args.limit_ns:.0f} ns")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
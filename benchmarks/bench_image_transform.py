@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+Compare rotating/flipping a webcam snapshot with Pillow (in-process) and ffmpeg (subprocess).
+
+Run it on the Pi, from the virtualenv OctoPrint is installed in (importing the image code loads the plugin
+package, which needs OctoPrint):
+
+    python benchmarks/bench_image_transform.py --ffmpeg /usr/bin/ffmpeg --image snapshot.jpg
+
+Without --image a 1280x720 test picture is generated (needs Pillow).
+"""
+import argparse
+import io
+import shutil
+import statistics
+import time
+
+from octoprint_OctoText import imaging
+
+
+def make_test_image(width, height):
+    from PIL import Image
+
+    image = Image.new("RGB", (width, height))
+    # some structure so the jpeg encoder has real work to do
+    pixels = image.load()
+    for x in range(0, width, 4):
+        for y in range(0, height, 4):
+            pixels[x, y] = (x % 256, y % 256, (x * y) % 256)
+    out = io.BytesIO()
+    image.save(out, "JPEG", quality=90)
+    return out.getvalue()
+
+
+def run(label, transform, data, runs):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        transform(data)
+        timings.append((time.perf_counter() - start) * 1000)
+    print(
+        f"{label:8} runs={runs} median={statistics.median(timings):8.1f} ms "
+        f"min={min(timings):8.1f} ms max={max(timings):8.1f} ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--image", help="jpeg to transform, default is a generated picture")
+    parser.add_argument("--ffmpeg", default=shutil.which("ffmpeg"), help="path to ffmpeg")
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--size", default="1280x720", help="size of the generated picture")
+    parser.add_argument("--no-rotate", action="store_true")
+    parser.add_argument("--hflip", action="store_true")
+    parser.add_argument("--vflip", action="store_true")
+    args = parser.parse_args()
+    rotate = not args.no_rotate
+
+    if args.image:
+        with open(args.image, "rb") as fp:
+            data = fp.read()
+    elif imaging.have_pillow():
+        width, height = (int(v) for v in args.size.split("x"))
+        data = make_test_image(width, height)
+    else:
+        parser.error("Pillow is needed to generate a test picture, pass --image")
+    print(f"{args.image or 'generated ' + args.size}: {len(data)} bytes")
+
+    if imaging.have_pillow():
+        run(
+            "pillow",
+            lambda image: imaging.pillow_transform(image, rotate, args.hflip, args.vflip),
+            data,
+            args.runs,
+        )
+    else:
+        print("pillow   not installed")
+
+    if args.ffmpeg:
+
+        def ffmpeg(image):
+            p = imaging.ffmpeg_transform(args.ffmpeg, image, rotate, args.hflip, args.vflip)
+            if p.returncode != 0:
+                raise RuntimeError(p.stderr.text)
+
+        run("ffmpeg", ffmpeg, data, args.runs)
+    else:
+        print("ffmpeg   not found, pass --ffmpeg")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+"""
+In-process stand-ins for the servers the plugin talks to, used by bench_delivery.py.
+
+FakeSMTPServer speaks just enough ESMTP for smtplib (EHLO, STARTTLS, AUTH PLAIN/LOGIN, MAIL, RCPT, DATA,
+NOOP, RSET, QUIT) and can be told to be slow, to fail connections, logins or sends, and to throttle like
+Outlook does. FakeSnapshotServer serves the same JPEG for every request, optionally after a delay.
+"""
+import email
+import email.policy
+import http.server
+import random
+import re
+import shutil
+import socketserver
+import ssl
+import subprocess
+import threading
+import time
+
+TOKEN = re.compile(r"bench-\d+")
+
+
+def make_certificate(folder):
+    """
+    Self-signed certificate for STARTTLS, smtplib does not verify it.
+
+    :return: (certificate file, key file)
+    """
+    openssl = shutil.which("openssl")
+    if openssl is None:
+        raise RuntimeError("openssl is needed to create a certificate for the fake SMTP server")
+    cert = f"{folder}/fake_smtp.crt"
+    key = f"{folder}/fake_smtp.key"
+    subprocess.run(
+        [openssl, "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1"]
+        + ["-subj", "/CN=localhost", "-keyout", key, "-out", cert],
+        check=True,
+        capture_output=True,
+    )
+    return cert, key
+
+
+class SMTPStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.logins = 0
+        self.messages = 0
+        self.refused = {}  # reason -> count
+        self.arrivals = {}  # bench token -> list of arrival times (time.monotonic)
+
+    def refuse(self, reason):
+        with self.lock:
+            self.refused[reason] = self.refused.get(reason, 0) + 1
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    def setup(self):
+        socketserver.StreamRequestHandler.setup(self)
+        self.tls = False
+
+    def reply(self, text):
+        self.wfile.write(text.encode("ascii") + b"\r\n")
+        self.wfile.flush()
+
+    def readline(self):
+        return self.rfile.readline(65536).decode("utf-8", "replace").rstrip("\r\n")
+
+    def handle(self):
+        server = self.server
+        stats = server.stats
+        with stats.lock:
+            stats.connections += 1
+        if server.chance(server.connect_failure_rate):
+            stats.refuse("connect")
+            self.reply("421 4.3.2 Service not available")
+            return
+        self.reply("220 fake ESMTP ready")
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            verb = line.split(" ", 1)[0].upper()
+            if verb in ("EHLO", "HELO"):
+                features = ["fake", "AUTH PLAIN LOGIN", "SIZE 35882577"]
+                if not self.tls:
+                    features.append("STARTTLS")
+                for feature in features[:-1]:
+                    self.reply("250-" + feature)
+                self.reply("250 " + features[-1])
+            elif verb == "STARTTLS":
+                self.reply("220 2.0.0 Ready to start TLS")
+                self.request = server.tls_context.wrap_socket(self.request, server_side=True)
+                self.rfile = self.request.makefile("rb")
+                self.wfile = self.request.makefile("wb")
+                self.tls = True
+            elif verb == "AUTH":
+                parts = line.split(" ")
+                if parts[1].upper() == "LOGIN":
+                    self.reply("334 VXNlcm5hbWU6")
+                    self.readline()
+                    self.reply("334 UGFzc3dvcmQ6")
+                    self.readline()
+                elif len(parts) < 3:
+                    self.reply("334 ")
+                    self.readline()
+                if server.chance(server.login_failure_rate):
+                    stats.refuse("login")
+                    self.reply("535 5.7.3 Authentication unsuccessful")
+                    continue
+                with stats.lock:
+                    stats.logins += 1
+                self.reply("235 2.7.0 Authentication successful")
+            elif verb == "MAIL":
+                if not server.take_token():
+                    stats.refuse("throttled")
+                    self.reply("451 4.7.500 Server busy, try again later")
+                    continue
+                self.reply("250 2.1.0 Sender OK")
+            elif verb == "RCPT":
+                self.reply("250 2.1.5 Recipient OK")
+            elif verb == "DATA":
+                self.reply("354 Start mail input; end with <CRLF>.<CRLF>")
+                lines = []
+                while True:
+                    data = self.readline()
+                    if data == ".":
+                        break
+                    lines.append(data[1:] if data.startswith("..") else data)
+                if server.latency:
+                    time.sleep(server.latency)
+                if server.chance(server.send_failure_rate):
+                    stats.refuse("send")
+                    self.reply("554 5.6.0 Message rejected")
+                    continue
+                self.received("\r\n".join(lines))
+                self.reply("250 2.0.0 OK queued")
+            elif verb in ("NOOP", "RSET"):
+                self.reply("250 2.0.0 OK")
+            elif verb == "QUIT":
+                self.reply("221 2.0.0 Bye")
+                return
+            else:
+                self.reply("502 5.5.2 Command not implemented")
+
+    def received(self, text):
+        now = time.monotonic()
+        message = email.message_from_string(text, policy=email.policy.default)
+        body = message.get_body(preferencelist=("plain",))
+        content = body.get_content() if body is not None else ""
+        stats = self.server.stats
+        with stats.lock:
+            stats.messages += 1
+            for token in set(TOKEN.findall(content)):
+                stats.arrivals.setdefault(token, []).append(now)
+
+
+class FakeSMTPServer(socketserver.ThreadingTCPServer):
+    """
+    SMTP stand-in on 127.0.0.1, every connection is served by its own thread.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(
+        self,
+        certificate,
+        latency=0.0,
+        connect_failure_rate=0.0,
+        login_failure_rate=0.0,
+        send_failure_rate=0.0,
+        throttle_per_minute=0,
+        seed=None,
+    ):
+        """
+        :param certificate: (certificate file, key file) for STARTTLS, see make_certificate
+        :param latency: seconds to wait before accepting each message
+        :param connect_failure_rate: fraction of connections answered with 421
+        :param login_failure_rate: fraction of logins refused with 535
+        :param send_failure_rate: fraction of messages refused with 554 after DATA
+        :param throttle_per_minute: more messages than this per minute get a 451, 0 for no limit
+        """
+        socketserver.ThreadingTCPServer.__init__(self, ("127.0.0.1", 0), _SMTPHandler)
+        self.tls_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        self.tls_context.load_cert_chain(*certificate)
+        self.latency = latency
+        self.connect_failure_rate = connect_failure_rate
+        self.login_failure_rate = login_failure_rate
+        self.send_failure_rate = send_failure_rate
+        self.throttle_per_minute = throttle_per_minute
+        self._tokens = float(throttle_per_minute)
+        self._stamp = time.monotonic()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.stats = SMTPStats()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def chance(self, rate):
+        with self._lock:
+            return rate > 0 and self._random.random() < rate
+
+    def take_token(self):
+        if self.throttle_per_minute <= 0:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            rate = self.throttle_per_minute / 60
+            self._tokens = min(
+                self.throttle_per_minute, self._tokens + (now - self._stamp) * rate
+            )
+            self._stamp = now
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+class _SnapshotHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+        if server.latency:
+            time.sleep(server.latency)
+        self.send_response(200)
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("Content-Length", str(len(server.image)))
+        self.end_headers()
+        self.wfile.write(server.image)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeSnapshotServer(http.server.ThreadingHTTPServer):
+    """
+    Webcam stand-in, http://127.0.0.1:<port>/snapshot returns image after latency seconds.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, image, latency=0.0):
+        http.server.ThreadingHTTPServer.__init__(self, ("127.0.0.1", 0), _SnapshotHandler)
+        self.image = image
+        self.latency = latency
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/snapshot"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
@@ -9,22 +9,47 @@
 #  Network (internet interruptions) happen frequently on Starlink, so this should be
 #  easy to test.
 #
+import asyncio
 import datetime
+import itertools
+import logging
 import os
 import smtplib
-import threading
 import time
 from email.message import EmailMessage
 from email.utils import formatdate
-from queue import Queue
+from queue import Empty, PriorityQueue
 from threading import Thread
 
 import flask
 import octoprint.events
 import octoprint.plugin
-import sarge
 from flask_login import current_user
 
+from . import imaging
+from .async_engine import AsyncDeliveryEngine, AsyncSMTPSender, have_aiosmtplib
+from .dedup import DEFAULT_DEDUP_WINDOWS, Deduplicator
+from .digest import build_digest, can_merge, destination_key, drop_stale_progress
+from .gcode_alerts import DEFAULT_ALERTS, AlertMatcher
+from .metrics import QueueMetrics, prometheus_text
+from .notify_queue import (
+    DEFAULT_PRIORITIES,
+    Notification,
+    NotificationQueue,
+    backoff_delay,
+)
+from .ratelimit import RateLimiter
+from .recipients import TRANSPORT_HEADER
+from .relays import RelaySelector
+from .scheduler import Scheduler
+from .settings_snapshot import SettingsSnapshot
+from .smtp_pool import SMTPConnectionPool, smtp_tls_context
+from .snapshot_cache import SnapshotCache
+from .spool import NotificationSpool
+from .thumbnails import ThumbnailIndex, ThumbnailPartCache
+from .tracing import Tracer
+from .transports import HTTP_E, HTTP_REFUSED, transports_from_settings
+
 # a few globals to save time checking for the existence of plugins
 
 
@@ -36,12 +61,77 @@ class OctoTextPlugin(
     octoprint.plugin.AssetPlugin,
     octoprint.plugin.SimpleApiPlugin,
     octoprint.plugin.TemplatePlugin,
+    octoprint.plugin.ShutdownPlugin,
+    octoprint.plugin.BlueprintPlugin,
 ):
-    notifyQ = Queue()
-    last_fired = None
     prusa_folder = ""
     cura_folder = ""
 
+    def initialize(self):
+        self._config = SettingsSnapshot.from_settings(self._settings)
+        # the asyncio delivery engine, when enabled, see on_after_startup
+        self._engine = None
+        self._async_smtp = None
+        # timed jobs, the time based progress notifications
+        self._scheduler = Scheduler(self._logger)
+        self._progress_job = None
+        self._progress_last = 0
+        # alert name -> time.monotonic() of the last line of a pause alert, see _on_gcode_alert
+        self._pause_alert_seen = {}
+        self._transports = transports_from_settings(
+            self._config.transports, self._logger
+        )
+        self._relays = RelaySelector(self._config.relays, self._config.relay_strategy)
+        self._smtp_pool = SMTPConnectionPool(
+            self._logger,
+            idle_timeout=self._config.smtp_idle_timeout,
+            max_idle=max(2, self._config.send_workers),
+        )
+        self._rate_limiter = RateLimiter(
+            self._config.rate_per_minute,
+            self._config.rate_burst,
+        )
+        self._queue_metrics = QueueMetrics()
+        # bounded, a long outage must not fill the memory with pictures, see notify_queue.py
+        self.notifyQ = NotificationQueue(on_drop=self._on_queue_drop)
+        self._configure_queue()
+        self._dedup = Deduplicator(self._config.dedup_windows)
+        # step timings for the metrics, and traces of a sample of the notifications
+        self._tracer = Tracer(
+            self.get_plugin_data_folder(),
+            sample_rate=self._config.trace_sample_rate,
+            max_kb=self._config.trace_max_kb,
+            metrics=self._queue_metrics,
+        )
+        # notifications waiting for their snapshot to be taken, see snapshot_worker. Entries are
+        # (priority, seq, job) so an error doesn't wait behind the snapshots of progress updates
+        self._prepareQ = PriorityQueue()
+        self._prepare_seq = itertools.count()
+        self._thumbnail_index = ThumbnailIndex([])
+        self._load_gcode_alerts()
+        self._thumbnail_parts = ThumbnailPartCache(
+            self._config.thumbnail_cache_size,
+            self._config.thumbnail_max_size,
+        )
+        self._snapshot_cache = SnapshotCache(
+            self._config.snapshot_cache_ttl
+        )
+        self._spool = None
+        if self._config.en_spool:
+            try:
+                self._spool = NotificationSpool(
+                    os.path.join(self.get_plugin_data_folder(), "spool.sqlite"),
+                    self._logger,
+                    max_messages=self._config.spool_max_messages,
+                    max_bytes=self._config.spool_max_mb * 1024 * 1024,
+                )
+            except Exception as e:
+                self._logger.exception(
+                    "Could not open the notification spool, queued messages will not survive a restart: {message}".format(
+                        message=str(e)
+                    )
+                )
+
     def email_message_queue_worker(self):
         """
         This function is started as a thread and blocks on a queue looking for work. It sends all
@@ -55,50 +145,354 @@ class OctoTextPlugin(
             LOGIN_E - for errors logging into the host email account
 
             SENDM_E - error sending email from server
+
+        Messages are spaced out per destination by a token bucket (rate_burst messages back to back, then
+        rate_per_minute) instead of a fixed pause after every message.
+
+        A message that fails with one of the errors above is parked in the queue with an exponential backoff
+        (retry_delay doubling up to retry_max_delay) and the worker moves on to the next message. After
+        retry_attempts tries the message is dropped from the queue and the spool.
+
+        send_workers of these threads run at the same time. The queue never hands two of them messages for
+        the same provider, so a slow gateway only holds up its own recipients.
         :return: None
         """
         while True:
             self._logger.debug("NO Work being done")
-            email_message = self.notifyQ.get()
-            # do the work
-            # self._logger.debug(f"processing email  {email_message}")
-            self._logger.debug(f"processing email  {email_message['Subject']}")
-            result = False
-            retries = 0
-            first_time = datetime.datetime.now()
-            orig_subject = email_message["Subject"]
-            while result is False:
-                if retries > 0:
-                    retry_str = " retries: " + str(retries)
-                else:
-                    retry_str = ""
+            try:
+                # wake up now and then to close SMTP sessions that have been idle too long, at most once a
+                # second - a timeout of 0 or less would make get() return at once and the thread spin
+                notification = self.notifyQ.get(
+                    timeout=max(1, self._smtp_pool.idle_timeout)
+                )
+            except Empty:
+                self._smtp_pool.expire()
+                continue
+            try:
+                self._deliver_notification(notification)
+            except Exception as e:
+                self._logger.exception(
+                    "Exception while sending notification '{subject}': {message}".format(
+                        subject=notification.subject, message=str(e)
+                    )
+                )
+            finally:
+                # other workers may take this provider's messages again
+                self.notifyQ.done(notification)
 
-                del email_message["Subject"]
-                email_message["Subject"] = orig_subject + retry_str
-                result = self._send_email_message(email_message)
+    def _deliver_notification(self, notification):
+        """
+        One send attempt for a notification taken off the queue by email_message_queue_worker.
+        """
+        with self._tracer.activate(notification.trace):
+            notification = self._begin_delivery(notification)
+            if notification is None:
+                return
+            result = self._send_email_message(
+                notification.message, notification.event_class
+            )
+            self._finish_delivery(notification, result)
 
-                retries += 1
-                if retries > 5:
-                    break
-                if result in ["SMTP_E", "LOGIN_E", "SENDM_E"]:
+    def _begin_delivery(self, notification):
+        """
+        Everything before the actual send: metrics, rate limit and digest. Only quick local work, the
+        asyncio engine calls this (and _finish_delivery) from its event loop.
 
-                    self._logger.debug(f"Retrying notification, error {result}")
-                    time.sleep(30)
-                    result = False
-                else:
-                    break
-            now_time = datetime.datetime.now()
-            elapsed_time = now_time - first_time
-            if (
-                elapsed_time.seconds > 29
-            ):  # >= time.sleep(30) says we had at least one delayed notice
+        :return: the Notification to send (a digest replaces the one taken off the queue), None when it
+                 was parked for later
+        """
+        email_message = notification.message
+        # the asyncio engine delivers every notification in a task of its own, the trace stays with the task
+        self._tracer.attach(notification.trace)
+        if notification.dequeued is None:
+            notification.dequeued = time.monotonic()
+            self._queue_metrics.on_dequeue(
+                notification.dequeued - notification.enqueued
+            )
+            if notification.trace is not None:
+                notification.trace.add(
+                    "queue_wait",
+                    notification.enqueued,
+                    notification.dequeued - notification.enqueued,
+                )
+
+        wait = self._rate_limiter.reserve(notification.destination)
+        if wait > 0:
+            self._logger.debug("Rate limit reached, holding message for %.1fs", wait)
+            self._queue_metrics.on_rate_limited()
+            self.notifyQ.put_delayed(notification, wait)
+            return None
+
+        if notification.attempts == 0 and self._config.en_digest:
+            notification = self._coalesce(notification)
+            email_message = notification.message
+
+        # do the work
+        # self._logger.debug(f"processing email  {email_message}")
+        if notification.attempts > 0:
+            del email_message["Subject"]
+            email_message["Subject"] = (
+                notification.subject + " retries: " + str(notification.attempts)
+            )
+        self._logger.debug("processing email  %s", email_message["Subject"])
+        return notification
+
+    def _finish_delivery(self, notification, result):
+        """
+        Book-keeping after a send attempt: park for a retry, give up or take it out of the spool.
+
+        :param result: what _send_email_message returned
+        """
+        notification.attempts += 1
+
+        if result in ["SMTP_E", "LOGIN_E", "SENDM_E", HTTP_E]:
+            if notification.attempts < self._config.retry_attempts:
+                delay = backoff_delay(
+                    notification.attempts,
+                    self._config.retry_delay,
+                    self._config.retry_max_delay,
+                )
                 self._logger.debug(
-                    f"Retries sending message: {retries}. Time message delayed: {elapsed_time}"
+                    "Retrying notification, error %s, next attempt in %.0fs", result, delay
                 )
-            self._logger.debug(f"Send Message result: {result}")
-            self.notifyQ.task_done()
-            time.sleep(60)  # make this adjustable?
-        pass
+                self._queue_metrics.on_retry(result)
+                self.notifyQ.put_delayed(notification, delay)
+                return
+            # taken out of the spool below as well, a message the server keeps refusing would otherwise
+            # be replayed on every start
+            self._logger.warning(
+                f"Giving up on notification '{notification.subject}' after "
+                f"{notification.attempts} attempts, last error {result}"
+            )
+
+        elapsed_time = time.monotonic() - notification.enqueued
+        if notification.attempts > 1:
+            self._logger.debug(
+                "Retries sending message: %s. Time message delayed: %s",
+                notification.attempts - 1,
+                datetime.timedelta(seconds=int(elapsed_time)),
+            )
+        self._logger.debug("Send Message result: %s", result)
+        self._queue_metrics.on_done(
+            elapsed_time, result is True, notification.event_class
+        )
+        for part in notification.parts or [notification]:
+            self._tracer.finish(part.trace, result)
+        self._unspool(notification)
+
+    def _coalesce(self, notification):
+        """
+        Merge the other waiting messages for the same recipients into one digest message.
+
+        :param notification: the Notification the worker is about to send
+        :return: notification unchanged when there is nothing to merge, otherwise a new digest Notification
+        """
+        if not can_merge(notification.message):
+            return notification
+        key = destination_key(notification.message)
+        others = self.notifyQ.take_matching(
+            lambda n: n.attempts == 0
+            and destination_key(n.message) == key
+            and can_merge(n.message),
+            self._config.digest_max - 1,
+        )
+        if not others:
+            return notification
+
+        merged = sorted([notification] + others, key=lambda n: n.seq)
+        merged, superseded = drop_stale_progress(merged)
+        self._queue_metrics.on_coalesced(len(others), len(superseded))
+        self._logger.debug(
+            "Merging %s notifications into a digest, %s stale progress update(s) dropped",
+            len(merged),
+            len(superseded),
+        )
+        for stale in superseded:
+            self._tracer.finish(stale.trace, "superseded")
+            self._unspool(stale)
+        if len(merged) == 1:
+            digest = merged[0]
+        else:
+            digest = Notification(
+                build_digest(merged),
+                priority=min(n.priority for n in merged),
+                event_class="digest",
+            )
+            digest.seq = min(n.seq for n in merged)
+            digest.enqueued = min(n.enqueued for n in merged)
+            digest.dequeued = notification.dequeued
+            digest.parts = merged
+            digest.trace = merged[0].trace
+        return digest
+
+    def _fan_out(self, email_message, event_class=None, recipients=None, spool_ids=None):
+        """
+        Queue a copy of email_message for every recipient that wants event_class.
+
+        :param recipients: the recipients picked by _admitted_recipients, None for all that want event_class
+        :param spool_ids: spool rows of the recipients' text only copies (see _spool_pending), replaced with
+                          the full messages
+        :return: number of messages queued
+        """
+        if recipients is None:
+            recipients = self._admitted_recipients(event_class)
+        if not recipients:
+            return 0
+        for index, recipient in enumerate(recipients):
+            self._enqueue_email_message(
+                recipient.address_message(
+                    email_message, copy_message=index < len(recipients) - 1
+                ),
+                event_class,
+                spool_ids[index] if spool_ids else None,
+            )
+        return len(recipients)
+
+    def _admitted_recipients(self, event_class, dedup_key=None):
+        """
+        :param dedup_key: (event type, file) of the notification, None when it is never a duplicate
+        :return: list of the recipients that want event_class and did not get the same notification within
+                 the suppression window, see dedup.py
+        """
+        recipients = [r for r in self._config.recipient_list if r.wants(event_class)]
+        if not recipients:
+            self._logger.debug("No recipient wants '%s' notifications", event_class)
+            return recipients
+        if dedup_key is None:
+            return recipients
+        event_type, file = dedup_key
+        admitted = [
+            r
+            for r in recipients
+            if self._dedup.admit(event_class, event_type, file, (r.address, r.transport))
+        ]
+        if len(admitted) < len(recipients):
+            self._logger.debug(
+                "Suppressed duplicate '%s' notification about %s for %s of %s recipients",
+                event_type,
+                file,
+                len(recipients) - len(admitted),
+                len(recipients),
+            )
+        return admitted
+
+    def _enqueue_email_message(self, email_message, event_class=None, spool_id=None):
+        self._queue_metrics.on_enqueue()
+        notification = Notification(
+            email_message,
+            priority=self._event_priority(event_class),
+            event_class=event_class,
+        )
+        notification.trace = self._tracer.current()
+        self._tracer.hold(notification.trace)
+        if self._spool is not None:
+            try:
+                if spool_id is None:
+                    notification.spool_id = self._spool.add(
+                        email_message, notification.priority, event_class
+                    )
+                else:
+                    notification.spool_id = self._spool.update(
+                        spool_id, email_message, notification.priority, event_class
+                    )
+            except Exception as e:
+                self._logger.exception(
+                    "Could not write notification to the spool: {message}".format(
+                        message=str(e)
+                    )
+                )
+        self.notifyQ.put(notification)
+
+    def _configure_queue(self):
+        self.notifyQ.configure(
+            max_messages=self._config.queue_max_messages,
+            max_bytes=self._config.queue_max_mb * 1024 * 1024,
+            overflow=self._config.queue_overflow,
+        )
+
+    def _on_queue_drop(self, notification):
+        """
+        A notification was dropped to make room in the full queue.
+        """
+        self._logger.warning(
+            f"Notification queue is full, dropping a {notification.event_class or 'custom'} notification"
+        )
+        for part in notification.parts or [notification]:
+            self._tracer.finish(part.trace, "dropped")
+        self._unspool(notification)
+
+    def _spool_pending(self, title, body, sender, event_class, recipients):
+        """
+        Spool a text only copy of a notification before its snapshot is taken, so it is still sent after a
+        restart while the webcam is slow. Runs on the snapshot worker, never on the event thread.
+
+        :return: spool id (None where writing failed) for every recipient, _fan_out replaces the rows with
+                 the full messages
+        """
+        spool_ids = [None] * len(recipients)
+        if self._spool is None:
+            return spool_ids
+        email_message = self._build_email_message(title, body, sender, send_image=False)[0]
+        priority = self._event_priority(event_class)
+        try:
+            for index, recipient in enumerate(recipients):
+                spool_ids[index] = self._spool.add(
+                    recipient.address_message(email_message), priority, event_class
+                )
+        except Exception as e:
+            self._logger.exception(
+                "Could not write notification to the spool: {message}".format(
+                    message=str(e)
+                )
+            )
+        return spool_ids
+
+    def _unspool(self, notification):
+        if self._spool is None:
+            return
+        for part in notification.parts:
+            self._unspool(part)
+        if notification.spool_id is not None:
+            self._spool_remove(notification.spool_id)
+
+    def _spool_remove(self, spool_id):
+        try:
+            self._spool.remove(spool_id)
+        except Exception as e:
+            self._logger.exception(
+                "Could not remove notification from the spool: {message}".format(
+                    message=str(e)
+                )
+            )
+
+    def _replay_spool(self):
+        """
+        Put messages left in the spool by the last run back on the queue.
+        """
+        if self._spool is None:
+            return
+        try:
+            entries = self._spool.load()
+        except Exception as e:
+            self._logger.exception(
+                "Could not read the notification spool: {message}".format(message=str(e))
+            )
+            return
+        for spool_id, created, priority, event_class, email_message in entries:
+            notification = Notification(
+                email_message, priority=priority, event_class=event_class
+            )
+            notification.spool_id = spool_id
+            self._queue_metrics.on_enqueue()
+            # the workers aren't running yet, waiting for room would only hold up the startup
+            self.notifyQ.put(notification, block=False)
+        if entries:
+            self._logger.info(
+                f"Replaying {len(entries)} notification(s) left over from the last run"
+            )
+
+    def _event_priority(self, event_class):
+        return self._config.priorities.get(event_class, DEFAULT_PRIORITIES["api"])
 
     ##~~ SettingsPlugin mixin
 
@@ -116,6 +510,7 @@ class OctoTextPlugin(
             "phone_numb": "8675309",
             "carrier_address": "mypixmessages.com",
             "push_message": None,
+            "transports": [],
             "progress_interval": 10,
             "en_progress_time": False,
             "en_progress": False,
@@ -131,13 +526,43 @@ class OctoTextPlugin(
             "show_fail_cancel": False,
             "mmu_timeout": 0,
             "use_ssl": False,
+            "smtp_relays": [],
+            "relay_strategy": "priority",
+            "smtp_keepalive": True,
+            "smtp_idle_timeout": 120,
+            "recipients": [],
+            "send_workers": 3,
+            "delivery_engine": "threads",
+            "async_max_in_flight": 10,
+            "rate_burst": 5,
+            "rate_per_minute": 2,
+            "retry_attempts": 6,
+            "retry_delay": 30,
+            "retry_max_delay": 900,
+            "priorities": dict(DEFAULT_PRIORITIES),
+            "dedup_windows": dict(DEFAULT_DEDUP_WINDOWS),
+            "en_spool": True,
+            "spool_max_messages": 200,
+            "spool_max_mb": 20,
+            "queue_max_messages": 200,
+            "queue_max_mb": 20,
+            "queue_overflow": "drop_progress",
+            "en_digest": True,
+            "digest_max": 10,
+            "image_backend": "auto",
+            "snapshot_max_size": 1280,
+            "snapshot_max_kb": 300,
+            "snapshot_cache_ttl": 10,
+            "thumbnail_cache_size": 32,
+            "thumbnail_max_size": 0,
+            "gcode_alerts": list(DEFAULT_ALERTS),
+            "gcode_alert_patterns": [],
+            "trace_sample_rate": 0.0,
+            "trace_max_kb": 1024,
         }
 
     def get_printer_name(self):
-        a_name = self._settings.global_get(["appearance", "name"])
-        if a_name == "":
-            a_name = "OctoText"
-        return a_name
+        return self._config.printer_name
 
     # ~~ PrintProgressPlugin
 
@@ -146,28 +571,37 @@ class OctoTextPlugin(
     def on_print_progress(self, storage, path, progress):
 
         self.current_path = path
-        if not self._settings.get(["en_progress"]):
+        if not self._config.en_progress:
             return
 
         if progress == 0:
             return
 
-        if self._settings.get(["en_progress_time"]):
+        if self._config.en_progress_time:
+            # the time based notifications come from the scheduler, a better estimate may move the next one
+            self._replan_progress()
             return
 
         # if these two events fire at the same time (printend and progress at 100%) we have two threads that are async
         # to each other that try to send notifications at the same time. This has caused both of these threads to fail
         # on a Pi 4 (not so much on a fast laptop). We default to letting the printend message do the work
-        if progress == 100 and self._settings.get(["en_printend"]):
+        if progress == 100 and self._config.en_printend:
             return
         # occasionally we don't get 99% messages from progress intervals (might be on short prints)
-        if progress % int(self._settings.get(["progress_interval"])) == 0:
+        if progress % self._config.progress_interval == 0:
             printer_name = self.get_printer_name()
             title = "Print Progress " + str(progress) + " percent finished."
             description = path
-            self._prepare_email_message_and_send(
-                title, description, printer_name, None, self._settings.get(["en_webcam"])
-            )
+            with self._tracer.activate(self._tracer.start("PrintProgress")):
+                self._prepare_email_message_and_send(
+                    title,
+                    description,
+                    printer_name,
+                    None,
+                    self._config.en_webcam,
+                    event_class="progress",
+                    dedup_key=("progress " + str(progress), path),
+                )
 
     ##~~ AssetPlugin mixin
 
@@ -187,7 +621,13 @@ class OctoTextPlugin(
         data = octoprint.plugin.SettingsPlugin.on_settings_load(self)
 
         # only return our restricted settings to admin users - this is only needed for OctoPrint <= 1.2.16
-        restricted = ("server_pass", "username", "servername")
+        restricted = (
+            "server_pass",
+            "username",
+            "servername",
+            "smtp_relays",
+            "transports",
+        )
         for r in restricted:
             if r in data and (
                 current_user is None
@@ -200,7 +640,15 @@ class OctoTextPlugin(
 
     def get_settings_restricted_paths(self):
         # only used in OctoPrint versions > 1.2.16
-        return {"admin": [["server_pass"], ["username"], ["servername"]]}
+        return {
+            "admin": [
+                ["server_pass"],
+                ["username"],
+                ["servername"],
+                ["smtp_relays"],
+                ["transports"],
+            ]
+        }
 
     def on_settings_save(self, data):
 
@@ -214,10 +662,42 @@ class OctoTextPlugin(
             data["username"] = None
 
         octoprint.plugin.SettingsPlugin.on_settings_save(self, data)
-
-    def smtp_login_server(self):
+        self._config = SettingsSnapshot.from_settings(self._settings)
+
+        # sessions logged in with the old account are useless now
+        self._smtp_pool.close_all()
+        self._smtp_pool.idle_timeout = self._config.smtp_idle_timeout
+        self._smtp_pool.max_idle = max(2, self._config.send_workers)
+        self._relays.configure(self._config.relays, self._config.relay_strategy)
+        for transport in self._transports.values():
+            transport.close()
+        self._transports = transports_from_settings(
+            self._config.transports, self._logger
+        )
+        if self._async_smtp is not None:
+            self._async_smtp.idle_timeout = self._config.smtp_idle_timeout
+            self._engine.submit(self._async_smtp.close_all)
+        self._rate_limiter.configure(
+            self._config.rate_per_minute,
+            self._config.rate_burst,
+        )
+        # size limits or webcam may have changed
+        self._snapshot_cache.ttl = self._config.snapshot_cache_ttl
+        self._snapshot_cache.clear()
+        self._load_gcode_alerts()
+        self._thumbnail_parts.maxsize = self._config.thumbnail_cache_size
+        self._thumbnail_parts.max_side = self._config.thumbnail_max_size
+        self._tracer.sample_rate = self._config.trace_sample_rate
+        self._dedup.configure(self._config.dedup_windows)
+        self._configure_queue()
+        self._tracer.max_kb = self._config.trace_max_kb
+
+    def smtp_login_server(self, relay=None):
         """
-        Login to the mail server
+        Login to the mail server. Opens a new connection every time, _send_email_message goes through
+        the connection pool and only ends up here when there is no usable session to reuse.
+
+        :param relay: SMTPRelay to log in to, the relay from the settings page when None
 
         :return:
             first position:
@@ -225,40 +705,31 @@ class OctoTextPlugin(
                 LOGIN_E for errors logging into the host email account
                 None for no error found.
             second position:
-                email address of the recipient when there is no error, None otherwise
-        """
-        global SMTP_server
-        name = self._settings.get(["smtp_name"])
-        port = self._settings.get(["smtp_port"])
-        # message = self._settings.get(["smtp_message"])
-        validate = self._settings.get(["validate_username"])
-        if validate:
-            login = self._settings.get(["username"])
-        else:
-            login = (
-                self._settings.get(["username"])
-                + "@"
-                + self._settings.get(["servername"])
-            )
-
-        passw = self._settings.get(["server_pass"])
-        phone_numb = self._settings.get(["phone_numb"])
-        carrier_addr = self._settings.get(["carrier_address"])
-        # alert = self._settings.get(["smtp_alert"])
+                the logged in smtplib connection when there is no error, None otherwise
+        """
+        if relay is None:
+            relay = self._config.relays[0]
+        name = relay.host
+        port = relay.port
+        login = relay.login
+        passw = relay.password
         self._logger.debug(name)
         self._logger.debug(port)
 
         # setup the server with the SMTP address/port
         try:
             self._logger.debug("before server smtplib")
-            if self._settings.get(["use_ssl"]):
-                SMTP_server = smtplib.SMTP_SSL(name, port, timeout=5)
-                SMTP_server.ehlo()
-            else:
-                SMTP_server = smtplib.SMTP(name, port, timeout=5)
-                error = SMTP_server.starttls()
-                self._logger.debug(f"startttls() {error}")
-            self._logger.debug(f"SMTP_server {SMTP_server}")
+            with self._tracer.span("smtp_connect"):
+                if relay.use_ssl:
+                    SMTP_server = smtplib.SMTP_SSL(
+                        name, port, timeout=5, context=smtp_tls_context()
+                    )
+                    SMTP_server.ehlo()
+                else:
+                    SMTP_server = smtplib.SMTP(name, port, timeout=5)
+                    error = SMTP_server.starttls(context=smtp_tls_context())
+                    self._logger.debug("startttls() %s", error)
+            self._logger.debug("SMTP_server %s", SMTP_server)
         except Exception as e:
             self._logger.exception(
                 "Exception while talking to your mail server {message}".format(
@@ -274,7 +745,8 @@ class OctoTextPlugin(
         ):  # Only use SMTP auth if the password has been supplied, skip if blank - issue #91
             self._logger.debug("Password supplied, attempting to log into mail server")
             try:
-                SMTP_server.login(login, passw)
+                with self._tracer.span("smtp_login"):
+                    SMTP_server.login(login, passw)
             except Exception as e:
                 self._logger.exception(
                     "Exception while logging into mail server {message}".format(
@@ -288,14 +760,26 @@ class OctoTextPlugin(
                 "Password not supplied, proceeding without SMTP authentication."
             )
 
-        email_addr = phone_numb + "@%s" % carrier_addr
-        return [None, email_addr]
+        return [None, SMTP_server]
 
     def _prepare_email_message_and_send(
-        self, title, body, sender=None, thumbnail=None, send_image=True, direct_send=False
+        self,
+        title,
+        body,
+        sender=None,
+        thumbnail=None,
+        send_image=True,
+        direct_send=False,
+        event_class=None,
+        gcode_path=None,
+        dedup_key=None,
     ):
         """
-        Prepare the email for sending and put it into the message queue or the email is directly sent
+        Prepare the email for sending and put it into the message queue or the email is directly sent.
+
+        Fetching the webcam snapshot and running ffmpeg can take seconds, and this is called from OctoPrint's
+        event dispatch thread. Unless direct_send is set the notification is only handed to snapshot_worker
+        here, which builds the email and puts it on the notification queue.
 
         :param title: Email title
         :param body: body of email
@@ -303,6 +787,11 @@ class OctoTextPlugin(
         :param thumbnail: thumbnail image path
         :param send_image: boolean True for thumbnail
         :param direct_send: boolean True for preformatted email
+        :param event_class: notification class (error, fail, pause, done, start, progress, upload...) used to
+                            look up the queue priority
+        :param gcode_path: file the notification is about, its thumbnail is attached if there is one
+        :param dedup_key: (event type, file) - recipients that got a notification with the same key within
+                          the suppression window of event_class don't get this one. None to always send.
         :return: SNAP - a failure to get an image from the webcam
         FILE_E - filesystem error
         True - no error
@@ -312,130 +801,229 @@ class OctoTextPlugin(
         SENDM_E - error sending email from server
         True - no error
         """
-        self._logger.debug(f"Preparing EMail '{title}' and adding to Notification-Queue")
-        self._logger.debug(
-            "Enable webcam setting {}".format(self._settings.get(["en_webcam"]))
-        )
+        if not direct_send:
+            # duplicates are dropped here, before any snapshot is taken
+            recipients = self._admitted_recipients(event_class, dedup_key)
+            if not recipients:
+                return True
+            self._logger.debug("Adding '%s' to the snapshot queue", title)
+            job = (
+                title,
+                body,
+                sender,
+                thumbnail,
+                send_image,
+                event_class,
+                gcode_path,
+                self._tracer.current(),
+                recipients,
+            )
+            self._prepareQ.put(
+                (self._event_priority(event_class), next(self._prepare_seq), job)
+            )
+            return True
+
+        thumbnail_part = None
+        if thumbnail is None and gcode_path is not None:
+            thumbnail_part = self._thumbnail_part(gcode_path)
+        email_message = self._build_email_message(
+            title, body, sender, thumbnail, send_image, thumbnail_part
+        )[0]
+        # one email to everybody plus one message per push transport, the first error is reported straight
+        # back to the user
+        recipients = [r for r in self._config.recipient_list if r.transport is None]
+        transports = [r for r in self._config.recipient_list if r.transport is not None]
+        results = []
+        for recipient in transports:
+            results.append(
+                self._send_email_message(recipient.address_message(email_message))
+            )
+        email_message["To"] = [r.address for r in recipients]
+        cc_set = [address for r in recipients for address in (r.cc or [])]
+        if cc_set:
+            self._logger.debug("Cc: settings - %s", cc_set)
+            email_message["Cc"] = cc_set
+        results.insert(0, self._send_email_message(email_message))
+        return next((result for result in results if result is not True), True)
+
+    def snapshot_worker(self):
+        """
+        Started as a thread, builds the emails (including webcam snapshots) for notifications handed over by
+        _prepare_email_message_and_send and puts them on the notification queue.
+        :return: None
+        """
+        self._build_thumbnail_index()
+        while True:
+            self._prepare_notification(self._prepareQ.get())
+
+    def _build_thumbnail_index(self):
+        # done by the worker, walking the thumbnail folders should not hold up the startup
+        found = self._thumbnail_index.build()
+        self._logger.debug("Thumbnail index built, %s thumbnails", found)
+
+    def _prepare_notification(self, entry):
+        """
+        Build the email for one _prepareQ entry and queue it for the recipients.
+        """
+        job = entry[-1]
+        (
+            title,
+            body,
+            sender,
+            thumbnail,
+            send_image,
+            event_class,
+            gcode_path,
+            trace,
+            recipients,
+        ) = job
+        # held until every recipient's notification is queued, so the trace isn't written out early
+        self._tracer.hold(trace)
+        try:
+            with self._tracer.activate(trace):
+                # a restart while the snapshot is taken still sends the text
+                spool_ids = self._spool_pending(title, body, sender, event_class, recipients)
+                thumbnail_part = None
+                if thumbnail is None and gcode_path is not None:
+                    thumbnail_part = self._thumbnail_part(gcode_path)
+                email_message = self._build_email_message(
+                    title, body, sender, thumbnail, send_image, thumbnail_part
+                )[0]
+                self._fan_out(email_message, event_class, recipients, spool_ids)
+        except Exception as e:
+            self._logger.exception(
+                "Exception while preparing notification '{title}': {message}".format(
+                    title=title, message=str(e)
+                )
+            )
+        finally:
+            self._tracer.finish(trace, None)
+
+    def _thumbnail_part(self, gcode_path):
+        """
+        :return: cached MIME part for the thumbnail of gcode_path, None when there is no thumbnail
+        """
+        with self._tracer.span("thumbnail_lookup"):
+            entry = self._thumbnail_index.lookup(gcode_path)
+        self._logger.debug("thumbnail for %s is: %s", gcode_path, entry)
+        if entry is None:
+            return None
+        try:
+            with self._tracer.span("thumbnail_load"):
+                return self._thumbnail_parts.get(entry)
+        except Exception as e:
+            self._logger.exception(
+                "Exception while opening file for thumbnail, {message}".format(
+                    message=str(e)
+                )
+            )
+            return None
+
+    def _build_email_message(
+        self,
+        title,
+        body,
+        sender=None,
+        thumbnail=None,
+        send_image=True,
+        thumbnail_part=None,
+    ):
+        """
+        Collect everything for the email: snapshot or thumbnail, sender and text. The recipients are filled in
+        by _fan_out, or by the caller for direct sends.
+
+        thumbnail is the path of a picture to attach, thumbnail_part an already encoded attachment from
+        the thumbnail cache. Either one replaces the webcam snapshot.
+
+        :return: [EmailMessage, result] - result is SNAP when the webcam image could not be fetched,
+                 True otherwise
+        """
+        self._logger.debug("Preparing EMail '%s'", title)
+        self._logger.debug("Enable webcam setting %s", self._config.en_webcam)
 
         result = True
-        delete_image_after_sent = False
         # collect all data for an email
         if sender is None:
             sender = "OctoText"
 
-        image_path = ""
-        if thumbnail is not None:
-            # prepare email with thumbnail
-            image_path = thumbnail
+        image_data = None
+        image_subtype = "jpeg"
+        if thumbnail_part is not None:
             pass
-        elif self._settings.get(["en_webcam"]) is False or send_image is False:
-            image_path = ""
+        elif thumbnail is not None:
+            # prepare email with thumbnail
+            try:
+                with open(thumbnail, "rb") as fp:
+                    image_data = fp.read()
+                image_subtype = "png"
+            except Exception as e:
+                self._logger.exception(
+                    "Exception while opening file for thumbnail, {message}".format(
+                        message=str(e)
+                    )
+                )
+        elif not self._config.en_webcam or send_image is False:
             pass
         else:
-            snapshot_url = self._settings.global_get(["webcam", "snapshot"])
-            self._logger.debug(f"Snapshot URL is: {snapshot_url}")
+            snapshot_url = self._config.snapshot_url
+            self._logger.debug("Snapshot URL is: %s", snapshot_url)
             if snapshot_url and send_image:
-                # email = self._create_email_with_snapshotimage()
-                image_path_dict = self._create_image_path_from_snapshot()
-                image_path = image_path_dict["path"]
-                result = image_path_dict["result"]
-                if result == "DELETE_IMAGE_AFTER_SENT":
-                    delete_image_after_sent = True
-            pass
+                # notifications firing close together share one snapshot
+                snapshot = self._snapshot_cache.get(
+                    self._fetch_snapshot, lambda snapshot: snapshot["result"] is not True
+                )
+                image_data = snapshot["data"]
+                result = snapshot["result"]
 
         appearance_name = self.get_printer_name()
-        self._logger.debug(f"Appearance name (subject): {appearance_name}")
+        self._logger.debug("Appearance name (subject): %s", appearance_name)
 
         if body is None:
             body = ""
 
-        fromAddr = (
-            self._settings.get(["username"]) + "@" + self._settings.get(["servername"])
-        )
-        # Send text message through SMS gateway of destination number/address
-        validate = self._settings.get(["validate_username"])
-        if validate:
-            fromAddr = self._settings.get(["username"])
-
-        phone_numb = self._settings.get(["phone_numb"])
-        carrier_addr = self._settings.get(["carrier_address"])
-        email_addr = phone_numb + "@%s" % carrier_addr
-
-        # setup email message with all collected data
-        email_message = EmailMessage()
-
-        cc_set = self._settings.get(["cc_field"])
-        if cc_set is not None:
-            cc_set = cc_set.replace("\n", "")
-            cc_set = cc_set.replace(" ", "")
-            cc_set = cc_set.split(",")
-            self._logger.debug(f"Cc: settings - {cc_set}")
-            email_message["Cc"] = cc_set
-
-        email_message["Subject"] = appearance_name + ": " + title
-        email_message["From"] = fromAddr  # 'OctoText@outlook.com'
-        email_message["To"] = email_addr
-        email_message["Date"] = formatdate(localtime=True)
-        content_string = " Message sent from: " + sender
-        email_message.set_content(
-            body + content_string, charset="utf-8"
-        )  # utf-8 allows non ascii characters in the test string
-        if image_path != "":
-            try:
-                fp = open(image_path, "rb")
-                filename = datetime.datetime.now().isoformat(timespec="minutes") + ".jpg"
-                email_message.add_attachment(
-                    fp.read(), maintype="image", subtype="jpg", filename=filename
+        fromAddr = self._config.from_addr
+
+        # setup email message with all collected data, To/Cc are filled in per recipient
+        with self._tracer.span("mime_build"):
+            email_message = EmailMessage()
+
+            email_message["Subject"] = appearance_name + ": " + title
+            email_message["From"] = fromAddr  # 'OctoText@outlook.com'
+            email_message["Date"] = formatdate(localtime=True)
+            content_string = " Message sent from: " + sender
+            email_message.set_content(
+                body + content_string, charset="utf-8"
+            )  # utf-8 allows non ascii characters in the test string
+            if thumbnail_part is not None:
+                email_message.make_mixed()
+                email_message.attach(thumbnail_part)
+            elif image_data is not None:
+                filename = (
+                    datetime.datetime.now().isoformat(timespec="minutes")
+                    + "."
+                    + image_subtype
                 )
-                fp.close()
-            except Exception as e:
-                self._logger.exception(
-                    "Exception while opening file for snapshot, {message}".format(
-                        message=str(e)
-                    )
+                email_message.add_attachment(
+                    image_data, maintype="image", subtype=image_subtype, filename=filename
                 )
-            if delete_image_after_sent:
-                try:
-                    os.remove(image_path)
-                except Exception as e:
-                    self._logger.exception(
-                        "Could not remove temporary snapshot file {} e:{}".format(
-                            image_path, str(e)
-                        )
-                    )
-                    # just logging, sending without image attached: return "FILE_E"
 
-        if direct_send:
-            result = self._send_email_message(email_message)
-        else:
-            self.notifyQ.put(email_message)
-        return result
+        return [email_message, result]
 
-    # load the snapshot image from camera, rotate and store the image into the filesystem. return the image path
-    # location return dict( path:thePath, result:"SNAP")
-    def _create_image_path_from_snapshot(self):
+    # load the snapshot image from camera and rotate it, all in memory. return dict( data:theBytes, result:"SNAP")
+    def _fetch_snapshot(self):
         try:
 
             # reading webcam snapshot image
-            import tempfile
-
             from requests import get
 
-            tempFile = tempfile.NamedTemporaryFile(delete=False)
-            snapshot_url = self._settings.global_get(["webcam", "snapshot"])
+            snapshot_url = self._config.snapshot_url
 
-            response = get(snapshot_url, verify=False, timeout=5)  # adding timeout on url
+            with self._tracer.span("snapshot_fetch"):
+                response = get(snapshot_url, verify=False, timeout=5)  # adding timeout on url
             response.raise_for_status()
-            tempFile.write(response.content)
-            tempFile.close()
-            # ffmpeg can't guess file type it seems
-            os.rename(tempFile.name, tempFile.name + ".jpg")
-            tempFile.name += ".jpg"
-
-            self._logger.debug(f"Webcam tempfile {tempFile.name}")
-            self._process_snapshot(tempFile.name)
+            self._logger.debug("Webcam snapshot %s bytes", len(response.content))
 
-            return {"path": tempFile.name, "result": "DELETE_IMAGE_AFTER_SENT"}
+            return {"data": self._process_snapshot(response.content), "result": True}
         except Exception as e:
             self._logger.exception(
                 "Exception while fetching snapshot from webcam: {message}".format(
@@ -443,83 +1031,242 @@ class OctoTextPlugin(
                 )
             )
             # send message without webcam snapshot (enabled but not available)
-            path = self._basefolder + "/static/img/offline.jpg"
-            return {"path": path, "result": "SNAP"}
+            return {"data": self._offline_image(), "result": "SNAP"}
         pass
 
+    _offline_image_data = None
+
+    def _offline_image(self):
+        if self._offline_image_data is None:
+            with open(self._basefolder + "/static/img/offline.jpg", "rb") as fp:
+                self._offline_image_data = fp.read()
+        return self._offline_image_data
+
     # Send the email to the smtp-server
-    def _send_email_message(self, email_message):
-        # login to the SMTP account and mail server
-        error, email_addr = self.smtp_login_server()
+    def _send_email_message(self, email_message, event_class=None):
+        """
+        Send through the first relay that works. A relay that can't be reached or refuses the login is
+        taken out of rotation for a while and the next one is tried right away. Messages for a push
+        transport go to the transport instead.
 
-        if not (error is None):
-            return error
+        :param event_class: notification class, passed on to push transports
+        :return: True, or the error of the last relay tried (SMTP_E, LOGIN_E, SENDM_E), HTTP_E or
+                 HTTP_REFUSED from a push transport
+        """
+        if email_message[TRANSPORT_HEADER] is not None:
+            return self._send_via_transport(email_message, event_class)
+        result = "SMTP_E"
+        for relay in self._relays.candidates():
+            started = time.monotonic()
+            self._use_relay_sender(relay, email_message)
+            result = self._send_via_relay(relay, email_message)
+            if self._relay_done(relay, result, started):
+                return result
+        return result
 
-        try:
-            SMTP_server.send_message(email_message)
-            # SMTP_server.sendmail(
-            #     email_message["From"], email_message["To"], email_message.as_string()
-            # )
-            SMTP_server.quit()
-        except Exception as e:
-            self._logger.exception(
-                "Exception while logging into SMTP server(send_email_message) {message}".format(
-                    message=str(e)
+    async def _send_email_message_async(self, email_message, event_class=None):
+        """
+        _send_email_message for the asyncio delivery engine, same relay failover and results.
+        """
+        if self._async_smtp is None or email_message[TRANSPORT_HEADER] is not None:
+            # no aiosmtplib, the blocking code runs in the event loop's thread pool
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                None, self._tracer.bind(self._send_email_message, email_message, event_class)
+            )
+        result = "SMTP_E"
+        for relay in self._relays.candidates():
+            started = time.monotonic()
+            self._use_relay_sender(relay, email_message)
+            result = await self._async_smtp.send(relay, email_message)
+            if self._relay_done(relay, result, started):
+                return result
+        return result
+
+    def _send_via_transport(self, email_message, event_class=None):
+        name = email_message[TRANSPORT_HEADER]
+        transport = self._transports.get(name)
+        if transport is None:
+            self._logger.warning(f"Dropping notification for unknown transport '{name}'")
+            return HTTP_REFUSED
+        with self._tracer.span("push_send"):
+            return transport.send(email_message, event_class)
+
+    def _use_relay_sender(self, relay, email_message):
+        # messages we built ourselves (or moved to another relay on an earlier attempt) are sent from the
+        # account of the relay, other plugins' messages keep their From
+        sender = email_message["From"]
+        if sender != relay.from_addr and sender in [r.from_addr for r in self._config.relays]:
+            del email_message["From"]
+            email_message["From"] = relay.from_addr
+
+    def _relay_done(self, relay, result, started):
+        """
+        Update the relay health with the result of a send.
+
+        :return: True when result is final, False to try the next relay
+        """
+        if result is True:
+            self._relays.on_success(relay, time.monotonic() - started)
+            return True
+        if result not in ("SMTP_E", "LOGIN_E"):
+            # the relay is fine, the message itself was refused
+            return True
+        cooldown = self._relays.on_failure(relay, result)
+        self._logger.warning(
+            f"SMTP relay {relay.name} failed ({result}), not using it for {cooldown:.0f}s"
+        )
+        return False
+
+    def _send_via_relay(self, relay, email_message):
+        if not self._config.smtp_keepalive:
+            # login to the SMTP account and mail server
+            error, SMTP_server = self.smtp_login_server(relay)
+            if not (error is None):
+                return error
+            try:
+                with self._tracer.span("smtp_send"):
+                    SMTP_server.send_message(email_message)
+                SMTP_server.quit()
+            except Exception as e:
+                self._logger.exception(
+                    "Exception while logging into SMTP server(send_email_message) {message}".format(
+                        message=str(e)
+                    )
                 )
+                return "SENDM_E"
+            return True
+
+        key = relay.key
+        while True:
+            # reuse a logged in session if there is one, otherwise this logs in to the mail server
+            error, SMTP_server, reused = self._smtp_pool.acquire(
+                key, lambda: self.smtp_login_server(relay)
             )
-            return "SENDM_E"
-        return True
+            if not (error is None):
+                return error
+
+            try:
+                with self._tracer.span("smtp_send"):
+                    SMTP_server.send_message(email_message)
+                # SMTP_server.sendmail(
+                #     email_message["From"], email_message["To"], email_message.as_string()
+                # )
+            except (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused) as e:
+                # the server refused this message, not the session. Reconnecting would only skip the retry
+                # backoff, and smtplib's exceptions are OSErrors, so this has to come before the clause below
+                self._smtp_pool.recycle(key, SMTP_server)
+                self._logger.exception(
+                    "Exception while logging into SMTP server(send_email_message) {message}".format(
+                        message=str(e)
+                    )
+                )
+                return "SENDM_E"
+            except (smtplib.SMTPServerDisconnected, OSError) as e:
+                self._smtp_pool.discard(SMTP_server)
+                if reused:
+                    # the server hung up on a pooled session, try again on a fresh connection
+                    self._logger.debug("Pooled SMTP session dropped (%s), reconnecting", e)
+                    continue
+                self._logger.exception(
+                    "Exception while logging into SMTP server(send_email_message) {message}".format(
+                        message=str(e)
+                    )
+                )
+                return "SENDM_E"
+            except Exception as e:
+                self._smtp_pool.discard(SMTP_server)
+                self._logger.exception(
+                    "Exception while logging into SMTP server(send_email_message) {message}".format(
+                        message=str(e)
+                    )
+                )
+                return "SENDM_E"
+            self._smtp_pool.release(key, SMTP_server)
+            return True
 
     # this code will rotate or flip the image based on the webcam settings. borrowed from foosel
-    def _process_snapshot(self, snapshot_path, pixfmt="yuv420p"):
-        hflip = self._settings.global_get_boolean(["webcam", "flipH"])
-        vflip = self._settings.global_get_boolean(["webcam", "flipV"])
-        rotate = self._settings.global_get_boolean(["webcam", "rotate90"])
-        ffmpeg = self._settings.global_get(["webcam", "ffmpeg"])
+    # Pillow does the work in-process when it is installed, ffmpeg is the fallback
+    def _process_snapshot(self, data, pixfmt="yuv420p"):
+        """
+        Rotate/flip the snapshot like the webcam settings say and shrink it to fit snapshot_max_size
+        (longest side in pixels) and snapshot_max_kb.
 
-        if (
-            not ffmpeg
-            or not os.access(ffmpeg, os.X_OK)
-            or (not vflip and not hflip and not rotate)
-        ):
-            return
+        :param data: jpeg from the webcam
+        :return: the processed jpeg, or data unchanged if there is nothing to do or it failed
+        """
+        hflip = self._config.webcam_flip_h
+        vflip = self._config.webcam_flip_v
+        rotate = self._config.webcam_rotate90
+        max_side = self._config.snapshot_max_size
+        max_bytes = self._config.snapshot_max_kb * 1024
 
-        ffmpeg_command = [ffmpeg, "-y", "-i", snapshot_path]
+        if not vflip and not hflip and not rotate and not max_side and not max_bytes:
+            return data
 
-        rotate_params = [f"format={pixfmt}"]  # workaround for foosel/OctoPrint#1317
-        if rotate:
-            rotate_params.append("transpose=2")  # 90 degrees counter clockwise
-        if hflip:
-            rotate_params.append("hflip")  # horizontal flip
-        if vflip:
-            rotate_params.append("vflip")  # vertical flip
+        if imaging.have_pillow() and self._config.image_backend != "ffmpeg":
+            try:
+                with self._tracer.span("image_pillow"):
+                    processed = imaging.pillow_transform(
+                        data, rotate, hflip, vflip, max_side, max_bytes
+                    )
+                if processed is not data:
+                    self._logger.debug(
+                        "Processed image with Pillow, %s -> %s bytes", len(data), len(processed)
+                    )
+                return processed
+            except Exception as e:
+                self._logger.debug("Exception processing image with Pillow %s", e)
 
-        ffmpeg_command += [
-            "-vf",
-            sarge.shell_quote(",".join(rotate_params)),
-            snapshot_path,
-        ]
-        self._logger.debug("Running: {}".format(" ".join(ffmpeg_command)))
-        try:
-            p = sarge.run(ffmpeg_command)
-        except Exception as e:
-            self._logger.debug(f"Exception running ffmpeg {e}")
-            return
+        # without Pillow we can't cheaply tell the picture size, only resize when it is over budget
+        if not vflip and not hflip and not rotate and not (max_bytes and len(data) > max_bytes):
+            return data
 
-        if p.returncode == 0:
-            self._logger.debug("Rotated/flipped image with ffmpeg")
-        else:
-            self._logger.warn(
-                "Failed to rotate/flip image with ffmpeg, "
-                "got return code {}: {}, {}".format(
-                    p.returncode, p.stdout.text, p.stderr.text
+        ffmpeg = self._config.ffmpeg
+        if not ffmpeg or not os.access(ffmpeg, os.X_OK):
+            return data
+
+        qscales = [None]
+        if max_bytes and len(data) > max_bytes:
+            qscales = imaging.BUDGET_QSCALES
+        for qscale in qscales:
+            if self._logger.isEnabledFor(logging.DEBUG):
+                self._logger.debug(
+                    "Running: %s",
+                    " ".join(
+                        imaging.ffmpeg_command(
+                            ffmpeg, rotate, hflip, vflip, pixfmt, max_side, qscale
+                        )
+                    ),
                 )
-            )
+            try:
+                with self._tracer.span("image_ffmpeg"):
+                    p = imaging.ffmpeg_transform(
+                        ffmpeg, data, rotate, hflip, vflip, pixfmt, max_side, qscale
+                    )
+            except Exception as e:
+                self._logger.debug("Exception running ffmpeg %s", e)
+                return data
+
+            if p.returncode != 0 or not p.stdout.bytes:
+                self._logger.warn(
+                    "Failed to rotate/flip image with ffmpeg, "
+                    "got return code {}: {}".format(p.returncode, p.stderr.text)
+                )
+                return data
+            processed = p.stdout.bytes
+            if not max_bytes or len(processed) <= max_bytes:
+                break
+        self._logger.debug(
+            "Processed image with ffmpeg, %s -> %s bytes", len(data), len(processed)
+        )
+        return processed
 
     def get_api_commands(self):
         return {
             "test": [],
             "data": ["some_parameter"],
+            "metrics": [],
         }  # dictionary of acceptable commands
 
     # Called by OctoPrint upon a POST request to /api/plugin/<plugin identifier>.
@@ -529,9 +1276,38 @@ class OctoTextPlugin(
     # format of post request from plugin:
     # r = requests.post('/api/plugin/OctoText', json={'param1': 'value1', 'param2': 'value2'})
     def on_api_command(self, command, data):
-        self._logger.debug(f"Got an API command: {command}, data: {data}")
+        self._logger.debug("Got an API command: %s, data: %s", command, data)
+        if command == "metrics":
+            return flask.jsonify(self._metrics())
         return flask.jsonify(result="ok")
 
+    def _metrics(self):
+        metrics = self._queue_metrics.snapshot(depth=self.notifyQ.qsize())
+        metrics["waiting_retry"] = self.notifyQ.waiting()
+        metrics["queue_bytes"] = self.notifyQ.nbytes()
+        metrics["queue_dropped"] = self.notifyQ.dropped
+        metrics["attachments_dropped"] = self.notifyQ.stripped
+        metrics["smtp_relays"] = self._relays.snapshot()
+        metrics["snapshot_fetches"] = self._snapshot_cache.fetches
+        metrics["snapshot_cache_hits"] = self._snapshot_cache.hits
+        metrics["thumbnail_cache_hits"] = self._thumbnail_parts.hits
+        metrics["thumbnail_cache_misses"] = self._thumbnail_parts.misses
+        metrics["dedup_suppressed"] = self._dedup.snapshot()
+        return metrics
+
+    ##~~ BlueprintPlugin mixin
+
+    # /plugin/OctoText/metrics for Prometheus, needs an API key like the rest of the API
+    @octoprint.plugin.BlueprintPlugin.route("/metrics", methods=["GET"])
+    def prometheus_metrics(self):
+        return flask.Response(
+            prometheus_text(self._metrics()),
+            mimetype="text/plain; version=0.0.4; charset=utf-8",
+        )
+
+    def is_blueprint_csrf_protected(self):
+        return True
+
     def receive_api_command(self, command, data, permissions=None):
         """
         Api messages from other plugins are received on this callback. A properly formatted EmailMessage is expected
@@ -546,7 +1322,7 @@ class OctoTextPlugin(
         if command != self._identifier:
             return
 
-        self._logger.debug(f"received a message command: {command}")
+        self._logger.debug("received a message command: %s", command)
 
         # TODO check the data before we put it on the queue
         # there is no way to notify the caller that there was an error so just log the
@@ -556,24 +1332,17 @@ class OctoTextPlugin(
         email_message = data
 
         if email_message["From"] is None:
-            email_message["From"] = (
-                self._settings.get(["username"])
-                + "@"
-                + self._settings.get(["servername"])
-            )
-
-        if email_message["To"] is None:
-            email_message["To"] = (
-                self._settings.get(["phone_numb"])
-                + "@"
-                + self._settings.get(["carrier_address"])
-            )
+            email_message["From"] = self._config.username + "@" + self._config.servername
 
         subject = email_message["Subject"]
         if subject is None:
             return False
-        # put it into the notify queue
-        self.notifyQ.put(email_message)
+        # put it into the notify queue, messages without a destination go to the recipients that want them
+        with self._tracer.activate(self._tracer.start("api")):
+            if email_message["To"] is None:
+                self._fan_out(email_message, "api")
+            else:
+                self._enqueue_email_message(email_message, "api")
 
         return True
 
@@ -581,19 +1350,22 @@ class OctoTextPlugin(
     def on_api_get(self, request):
 
         self._logger.debug("The test button was pressed...")
-        self._logger.debug(f"request = {request}")
+        self._logger.debug("request = %s", request)
 
         try:
             self._logger.debug("Sending text with image")
 
             # title, body, sender=None, thumbnail=None, send_image=True, direct_send=True
-            result = self._prepare_email_message_and_send(
-                "Test from the OctoText Plugin.",
-                self._settings.get(["smtp_message"]),
-                sender="OctoText",
-                direct_send=True,
-            )
-            pass
+            trace = self._tracer.start("test")
+            self._tracer.hold(trace)
+            with self._tracer.activate(trace):
+                result = self._prepare_email_message_and_send(
+                    "Test from the OctoText Plugin.",
+                    self._config.smtp_message,
+                    sender="OctoText",
+                    direct_send=True,
+                )
+            self._tracer.finish(trace, result)
         except Exception as e:
             self._logger.exception(
                 "Exception while sending text, {message}".format(message=str(e))
@@ -601,7 +1373,7 @@ class OctoTextPlugin(
             return flask.make_response(flask.jsonify(result=False, error="SMTP_E"))
 
         # result = True
-        self._logger.debug(f"String returned from send_message_with_webcam {result}")
+        self._logger.debug("String returned from send_message_with_webcam %s", result)
         if not (result is True):
             error = result
             result = False
@@ -617,12 +1389,10 @@ class OctoTextPlugin(
         self._logger.info(f"OctoText started: {self._plugin_version}")
         self._logger.info(
             "SMTP Name: {}, SMTP port: {}, SMTP message: {}, server login: {}".format(
-                self._settings.get(["smtp_name"]),
-                self._settings.get(["smtp_port"]),
-                self._settings.get(["smtp_message"]),
-                self._settings.get(["username"])
-                + "@"
-                + self._settings.get(["servername"]),
+                self._config.smtp_name,
+                self._config.smtp_port,
+                self._config.smtp_message,
+                self._config.username + "@" + self._config.servername,
             )
         )
         # on loading of plugin look for the existence of the prusa or cura thumbnail plugins
@@ -637,121 +1407,256 @@ class OctoTextPlugin(
             self._logger.info(f"Prusa thumbnail loaded: {self.prusa_folder}")
         if os.path.exists(self.cura_folder):
             self._logger.info(f"Cura thumbnails loaded: {self.cura_folder}")
+        self._thumbnail_index.folders = [self.prusa_folder, self.cura_folder]
         self._logger.info("--------------------------------------------")
-        Thread(target=self.email_message_queue_worker, daemon=True).start()
+        self._replay_spool()
+        self._scheduler.start()
+        if self._config.delivery_engine == "asyncio":
+            self._start_async_engine()
+        else:
+            for _ in range(max(1, self._config.send_workers)):
+                Thread(target=self.email_message_queue_worker, daemon=True).start()
+            Thread(target=self.snapshot_worker, daemon=True).start()
 
         # TODO Not needed,  only helper-function allowed: self._plugin_manager.register_message_receiver(self.receive_api_command)
 
+    def _start_async_engine(self):
+        if have_aiosmtplib():
+            self._async_smtp = AsyncSMTPSender(
+                self._logger,
+                idle_timeout=self._config.smtp_idle_timeout,
+                max_idle=max(2, self._config.async_max_in_flight),
+                tracer=self._tracer,
+            )
+        else:
+            self._logger.info(
+                "aiosmtplib is not installed, the asyncio engine sends with smtplib in a thread pool"
+            )
+        self._engine = AsyncDeliveryEngine(
+            self._logger,
+            self.notifyQ,
+            self._prepareQ,
+            self._begin_delivery,
+            self._send_email_message_async,
+            self._finish_delivery,
+            self._prepare_notification,
+            startup=self._build_thumbnail_index,
+            idle=self._async_idle,
+            shutdown=self._async_shutdown,
+            max_in_flight=self._config.async_max_in_flight,
+        )
+        self._engine.start()
+        self._logger.info("Notifications are delivered by the asyncio engine")
+
+    async def _async_idle(self):
+        self._smtp_pool.expire()
+        if self._async_smtp is not None:
+            await self._async_smtp.expire()
+
+    async def _async_shutdown(self):
+        if self._async_smtp is not None:
+            await self._async_smtp.close_all()
+
+    def on_shutdown(self):
+        self._scheduler.stop()
+        if self._engine is not None:
+            self._engine.stop()
+        for transport in self._transports.values():
+            transport.close()
+        self._smtp_pool.close_all()
+        if self._spool is not None:
+            self._spool.close()
+
     # ~~ callback for pause initiated by the printer (very specific to Prusa)
     # to test the strings being received by the Pi put this in the console: !!DEBUG:send echo:busy: paused for user
+    #
+    # This runs for every line received from the printer. The matcher rejects ordinary lines with a single
+    # startswith() check, everything else (settings, time) is only looked at once a line matched.
 
     def AlertWaitingForUser(self, comm, line, *args, **kwargs):
-        if self.last_fired is not None:
-            right_now = datetime.datetime.now()
-            how_long = right_now - self.last_fired
-            # self._logger.debug(
-            #    f"last fired {last_fired}, right_now {right_now} seconds {how_long.seconds}"
-            # )
-            mmutimeout = int(self._settings.get(["mmu_timeout"]))
-            # any setting less than 30 seconds disables the check
-            if mmutimeout < 30:
-                return line
-            if how_long.seconds < mmutimeout:
-                return line
-        if "echo:busy: paused for user" in line:
-            self._logger.info(f"State ID: {self._printer.get_state_id()}")
-            if self._printer.get_state_id() == "PRINTING":
-                self.last_fired = datetime.datetime.now()
-                payload = dict([("name", "printer"), ("user", "system")])
-                self.on_event(octoprint.events.Events.PRINT_PAUSED, payload)
+        alert = self._gcode_alerts.match(line)
+        if alert is not None:
+            self._on_gcode_alert(alert, line)
         return line
 
-    def find_thumbnail(self, filename):
-
-        thumb_filename = None
-        prusa_thumb_filename = (
-            self.prusa_folder + "/" + filename.replace(".gcode", ".png")
+    def _load_gcode_alerts(self):
+        self._gcode_alerts = AlertMatcher.from_settings(
+            self._config.gcode_alerts,
+            self._config.gcode_alert_patterns,
+            self._logger,
         )
-        cura_thumb_filename = self.cura_folder + "/" + filename.replace(".gcode", ".png")
-
-        if os.path.exists(prusa_thumb_filename):
-            thumb_filename = prusa_thumb_filename
-        elif os.path.exists(cura_thumb_filename):
-            thumb_filename = cura_thumb_filename
-        self._logger.debug(f"thumbnail filename path is: {thumb_filename}")
-        if thumb_filename is not None and os.path.exists(thumb_filename):
-            self._logger.debug("thumbnail exists! using image in notifications")
-        return thumb_filename
-
-    # ~~ thread for time based notification
-    # setting the flag stopme will cause the thread to exit
-    def time_thread(self, stopme):
-        ptl = None
-        while ptl is None:
-            time.sleep(1)
-            if stopme.is_set():
+
+    # a pause alert line after this many quiet seconds is a new pause, the printer repeats it every ~2 seconds
+    PAUSE_ALERT_GAP = 10
+
+    def _on_gcode_alert(self, alert, line):
+        if alert.event_class == "pause" and self._config.mmu_timeout < 30:
+            # a pause timeout under 30 seconds means one notification per pause
+            now = time.monotonic()
+            last = self._pause_alert_seen.get(alert.name)
+            self._pause_alert_seen[alert.name] = now
+            if last is not None and now - last < self.PAUSE_ALERT_GAP:
                 return
-            progr = self._printer.get_current_data()["progress"]
-            ptl = progr["printTimeLeft"]
-        self._logger.debug(f"progress: {ptl}")
-        while not stopme.is_set():
-            progr = self._printer.get_current_data()["progress"]
-            total_time = progr["printTime"] + progr["printTimeLeft"]
-            interval = (
-                int(self._settings.get(["progress_interval"])) / 100 * int(total_time)
-            )
-            interval = int(interval)
-            self._logger.debug(f"interval: {interval}")
-            time.sleep(interval)
-
-            # send the message to the queue
-            progr = self._printer.get_current_data()["progress"]
-            pt_current = progr["printTimeLeft"]
-            if pt_current is None or pt_current == 0 or stopme.is_set():
-                self._logger.debug("Exiting time thread!")
+        # printers repeat these while they wait, the repeats are suppressed by the dedup_windows (the pause
+        # window is the "Pause interval timeout" from the settings page when that is set). This runs for
+        # every repeat, so it only logs at debug level.
+        if alert.event_class == "pause":
+            state = self._printer.get_state_id()
+            self._logger.debug("Printer alert %s, State ID: %s", alert.name, state)
+            if state != "PRINTING":
                 return
-            # progress = int((pt_current / ptl) * 100)
-            time_left = datetime.timedelta(seconds=int(pt_current))
-            self._logger.debug(f"Print time left {time_left}")
-            printer_name = self.get_printer_name()
-            # title = "Print Progress " + str(progress) + " percent left."
-            title = "Print Progress " + str(time_left) + " time to finish."
-            description = self.current_path
+        else:
+            self._logger.debug("Printer alert %s", alert.name)
 
-            self._prepare_email_message_and_send(
-                title, description, printer_name, None, self._settings.get(["en_webcam"])
-            )
-        return
+        if alert.name == "paused_for_user":
+            payload = dict([("name", "printer"), ("user", "system")])
+            self.on_event(octoprint.events.Events.PRINT_PAUSED, payload)
+            return
+
+        enable = "en_error" if alert.event_class == "error" else "en_printpaused"
+        if not getattr(self._config, enable):
+            return
+        self._prepare_email_message_and_send(
+            alert.title,
+            f"Printer reported: {line.strip()}",
+            self.get_printer_name(),
+            event_class=alert.event_class,
+            dedup_key=(alert.name, None),
+        )
+
+    # ~~ time based progress notifications
+    # one job per print on the shared scheduler, planned from OctoPrint's estimate of the print time. Each
+    # notification is planned from the previous planned time (not from when the last one went out), so the
+    # messages don't drift later and later over a long print.
 
-    # ~~ Simple function to start and stop the time thread
-    stopme = threading.Event()
+    # seconds between looks at the printer until OctoPrint has an estimate of the print time
+    ETA_POLL = 10
+    # never more than one time based notification in this many seconds
+    MIN_PROGRESS_INTERVAL = 60
 
-    def manage_progress_thread(self, stop=False):
-        if stop:
-            self.stopme.set()
+    def _start_progress_timer(self):
+        self._progress_last = time.monotonic()
+        self._progress_job = self._scheduler.schedule(
+            "progress", self.ETA_POLL, self._progress_due
+        )
+
+    def _stop_progress_timer(self):
+        if self._scheduler.cancel("progress"):
+            self._logger.debug("Time based progress notifications stopped")
+
+    def _progress_interval(self):
+        """
+        :return: seconds between two notifications for the current print time estimate, None when there is no
+                 estimate yet
+        """
+        progr = self._printer.get_current_data()["progress"]
+        if progr["printTimeLeft"] is None or progr["printTime"] is None:
+            return None
+        total_time = progr["printTime"] + progr["printTimeLeft"]
+        return max(
+            self.MIN_PROGRESS_INTERVAL,
+            self._config.progress_interval / 100 * total_time,
+        )
+
+    def _replan_progress(self):
+        """
+        Move the next notification when the print time estimate changed, called from on_print_progress.
+        """
+        job = self._progress_job
+        if job is None or job.cancelled:
+            return
+        interval = self._progress_interval()
+        if interval is None:
+            return
+        due = self._progress_last + interval
+        # only bother for changes of more than 5%
+        if job.due is not None and abs(job.due - due) > interval * 0.05:
+            self._logger.debug("Progress interval now %.0fs, replanning", interval)
+            self._scheduler.reschedule(job, due - time.monotonic())
+
+    def _progress_due(self, job):
+        interval = self._progress_interval()
+        if interval is None:
+            # OctoPrint has no estimate yet, look again in a bit
+            self._scheduler.reschedule(job, self.ETA_POLL)
+            return
+        now = time.monotonic()
+        due = self._progress_last + interval
+        if due > now + 1:
+            # the estimate went up since this was planned
+            self._scheduler.reschedule(job, due - now)
             return
-        self.stopme.clear()
-        Thread(target=self.time_thread, daemon=True, args=(self.stopme,)).start()
-        return
+
+        pt_current = self._printer.get_current_data()["progress"]["printTimeLeft"]
+        if not pt_current:
+            self._logger.debug("Print is ending, no more time based notifications")
+            return
+        # a notification that is very late (the Pi was busy, the clock jumped) starts a new plan
+        self._progress_last = due if now - due < interval else now
+        self._scheduler.reschedule(job, self._progress_last + interval - now)
+
+        time_left = datetime.timedelta(seconds=int(pt_current))
+        self._logger.debug("Print time left %s", time_left)
+        printer_name = self.get_printer_name()
+        title = "Print Progress " + str(time_left) + " time to finish."
+        description = self.current_path
+
+        with self._tracer.activate(self._tracer.start("PrintProgress")):
+            self._prepare_email_message_and_send(
+                title,
+                description,
+                printer_name,
+                None,
+                self._config.en_webcam,
+                event_class="progress",
+            )
 
     # ~~ EventPlugin API
 
     def on_event(self, event, payload):
 
-        noteType = title = description = None
+        noteType = title = description = event_class = None
         do_cam_snapshot = True
-        thumbnail_filename = None
+        gcode_path = None
+
+        # keep the thumbnail index in step with the files, memory only - no disk access on the event thread
+        if event in (
+            octoprint.events.Events.FILE_ADDED,
+            octoprint.events.Events.FILE_REMOVED,
+        ):
+            self._thumbnail_index.forget(payload["path"])
+            return
+        elif event == octoprint.events.Events.FOLDER_REMOVED:
+            self._thumbnail_index.forget_folder(payload["path"])
+            return
+        elif event == octoprint.events.Events.SETTINGS_UPDATED:
+            # webcam and appearance settings are saved by OctoPrint, not through on_settings_save
+            self._config = SettingsSnapshot.from_settings(self._settings)
+            return
+
+        # with en_progress_time progress messages are sent every progress_interval percent of the estimated
+        # print time instead of every progress_interval percent of the file. The timer runs from the start of
+        # a print until it ends, whether or not these events send notifications themselves.
+        if event == octoprint.events.Events.PRINT_STARTED:
+            if self._config.en_progress_time:
+                self._start_progress_timer()
+        elif event in (
+            octoprint.events.Events.PRINT_DONE,
+            octoprint.events.Events.PRINT_FAILED,
+            octoprint.events.Events.PRINT_CANCELLED,
+            octoprint.events.Events.ERROR,
+        ):
+            self._stop_progress_timer()
 
         if event == octoprint.events.Events.UPLOAD:
 
-            if not self._settings.get(["en_upload"]):
+            if not self._config.en_upload:
                 return
 
             file = payload["name"]
             target = payload["path"]
-            path_to_thumbnail = self.find_thumbnail(file)
-            self._logger.debug(f"Upload event - thumbnail filename {path_to_thumbnail}")
             noteType = True
+            event_class = "upload"
             title = "A file was uploaded "
             description = "{file} was uploaded {targetString}".format(
                 file=file, targetString="to SD" if target == "sd" else "locally"
@@ -760,69 +1665,62 @@ class OctoTextPlugin(
 
         elif event == octoprint.events.Events.PRINT_STARTED:
 
-            if not self._settings.get(["en_printstart"]):
+            if not self._config.en_printstart:
                 return
 
-            self._logger.debug(f"Print started event: {payload}")
+            self._logger.debug("Print started event: %s", payload)
             file = os.path.basename(payload["name"])
             origin = payload["origin"]
 
             noteType = True
+            event_class = "start"
             title = "Print job started"
             description = "{file} has started printing {originString}.".format(
                 file=file, originString="from SD" if origin == "sd" else "locally"
             )
-            thumbnail_filename = self.find_thumbnail(file)
-
-            # if we have enabled en_progress_time then we will want to use a different method of sending progress
-            # messages. This will mean starting a thread that waits for a specific period of time before sending an
-            # notification. we will need to stop the thread on print cancel, error or ending events
-
-            if self._settings.get(["en_progress_time"]):
-                self.manage_progress_thread()
+            # the thumbnail is looked up by the snapshot worker
+            gcode_path = payload["path"]
 
         elif event == octoprint.events.Events.PRINT_DONE:
 
-            if not self._settings.get(["en_printend"]):
+            if not self._config.en_printend:
                 return
 
             file = os.path.basename(payload["name"])
             elapsed_time = datetime.timedelta(seconds=int(payload["time"]))
 
-            self._logger.debug(f"Event received: {event}, print done: {file}")
+            self._logger.debug("Event received: %s, print done: %s", event, file)
             noteType = True
+            event_class = "done"
             title = "Print job finished"
             description = (
                 "{file} \n\rfinished printing, elapsed time: {elapsed_time}.".format(
                     file=file, elapsed_time=elapsed_time
                 )
             )
-            if self._settings.get(["en_progress_time"]):
-                self.manage_progress_thread(stop=True)
 
         elif event == octoprint.events.Events.ERROR:
 
-            if not self._settings.get(["en_error"]):
+            if not self._config.en_error:
                 return
 
             error = payload["error"]
 
             noteType = True
+            event_class = "error"
             title = "Printer ERROR!"
             description = f" {error}"
-            self._logger.debug(f"Event received: {event}, print error: {error}")
-            if self._settings.get(["en_progress_time"]):
-                self.manage_progress_thread(stop=True)
+            self._logger.debug("Event received: %s, print error: %s", event, error)
 
         elif event == octoprint.events.Events.PRINT_CANCELLED:
 
-            if not self._settings.get(["show_fail_cancel"]):
+            if not self._config.show_fail_cancel:
                 return
-            if self._settings.get(["en_printfail"]) == "Fail":
+            if self._config.en_printfail == "Fail":
                 return
 
-            settingf = self._settings.get(["en_printfail"])
-            self._logger.debug(f"Event received: {event}, print fail: {settingf}")
+            settingf = self._config.en_printfail
+            self._logger.debug("Event received: %s, print fail: %s", event, settingf)
             name = payload["name"]
             try:
                 user = payload["user"]
@@ -830,35 +1728,32 @@ class OctoTextPlugin(
                 user = "system"
 
             noteType = True
+            event_class = "cancel"
             title = "Print canceled by " + user
             description = f"file: {name}"
-            if self._settings.get(["en_progress_time"]):
-                self.manage_progress_thread(stop=True)
 
         elif event == octoprint.events.Events.PRINT_FAILED:
 
-            if not self._settings.get(["show_fail_cancel"]):
+            if not self._config.show_fail_cancel:
                 return
-            if self._settings.get(["en_printfail"]) == "Cancel":
+            if self._config.en_printfail == "Cancel":
                 return
 
-            settingf = self._settings.get(["en_printfail"])
-            self._logger.debug(f"Event received: {event}, print fail: {settingf}")
+            settingf = self._config.en_printfail
+            self._logger.debug("Event received: %s, print fail: %s", event, settingf)
             reason = payload["reason"]
             name = payload["name"]
             time = payload["time"]
             time = str(int(time))  # time is a float
 
             noteType = True
+            event_class = "fail"
             title = "Print Fail after " + time + " seconds"
             description = f"{reason} file: {name}"
 
-            if self._settings.get(["en_progress_time"]):
-                self.manage_progress_thread(stop=True)
-
         elif event == octoprint.events.Events.PRINT_PAUSED:
 
-            if not self._settings.get(["en_printpaused"]):
+            if not self._config.en_printpaused:
                 return
 
             pay_name = payload["name"]
@@ -875,20 +1770,23 @@ class OctoTextPlugin(
             time = datetime.datetime.now().isoformat(sep=" ", timespec="minutes")
 
             noteType = True
+            event_class = "pause"
             title = "Print Paused by " + user + " at " + time
             if pay_name == "printer":
                 description = "Pause for user detected. Out of Filament?"
             else:
                 description = f"file: {pay_name}"
             self._logger.debug(
-                "Print paused args notetype: {}, name:{}, title {}, description {}".format(
-                    noteType, pay_name, title, description
-                )
+                "Print paused args notetype: %s, name:%s, title %s, description %s",
+                noteType,
+                pay_name,
+                title,
+                description,
             )
 
         elif event == octoprint.events.Events.PRINT_RESUMED:
 
-            if not self._settings.get(["en_printresumed"]):
+            if not self._config.en_printresumed:
                 return
 
             pay_name = payload["name"]
@@ -903,12 +1801,15 @@ class OctoTextPlugin(
             time = datetime.datetime.now().isoformat(sep=" ", timespec="minutes")
 
             noteType = True
+            event_class = "resume"
             title = "Resumed by " + user + " at " + time
             description = f"file: {pay_name}"
             self._logger.debug(
-                "Print resumed args notetype: {}, name:{}, title {}, description {}".format(
-                    noteType, pay_name, title, description
-                )
+                "Print resumed args notetype: %s, name:%s, title %s, description %s",
+                noteType,
+                pay_name,
+                title,
+                description,
             )
 
         if noteType is None:
@@ -916,9 +1817,22 @@ class OctoTextPlugin(
 
         printer_name = self.get_printer_name()
 
-        self._prepare_email_message_and_send(
-            title, description, printer_name, thumbnail_filename, do_cam_snapshot
-        )
+        # a sampled event is traced from here to the last send attempt of its notifications. Errors have no
+        # file, the message tells them apart
+        with self._tracer.activate(self._tracer.start(event)), self._tracer.span("event"):
+            self._prepare_email_message_and_send(
+                title,
+                description,
+                printer_name,
+                None,
+                do_cam_snapshot,
+                event_class=event_class,
+                gcode_path=gcode_path,
+                dedup_key=(
+                    event,
+                    payload.get("path") or payload.get("name") or payload.get("error"),
+                ),
+            )
 
     ##~~ Softwareupdate hook
 
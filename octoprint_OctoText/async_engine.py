@@ -0,0 +1,330 @@
+# -*- coding: utf-8 -*-
+# Optional asyncio delivery engine, selected with the "delivery_engine" setting.
+#
+# Instead of send_workers threads that each block in smtplib, a single thread runs an asyncio event loop
+# with up to async_max_in_flight sends going at once, and builds the emails (snapshots, ffmpeg) for new
+# notifications alongside. Messages still come from the plugin's NotificationQueue and _prepareQ, so
+# receive_api_command, the spool, digests, rate limiting, relay failover and retries all work the same as
+# with the threaded workers.
+#
+# SMTP goes through aiosmtplib when it is installed. Without it the blocking smtplib code runs in the
+# loop's thread pool, which still overlaps the sends but costs a thread for every send in flight.
+#
+import asyncio
+import contextlib
+import threading
+import time
+from queue import Empty
+
+from .smtp_pool import smtp_tls_context
+
+try:
+    import aiosmtplib
+except ImportError:
+    aiosmtplib = None
+
+
+def have_aiosmtplib():
+    return aiosmtplib is not None
+
+
+class AsyncSMTPSender:
+    """
+    aiosmtplib sessions per relay, kept open between messages like SMTPConnectionPool does for smtplib.
+    Only used from the event loop thread, so there is no locking.
+    """
+
+    def __init__(
+        self, logger, idle_timeout=120, noop_after=15, max_idle=4, timeout=5, tracer=None
+    ):
+        """
+        :param logger: logger for connection errors
+        :param idle_timeout: seconds a session may sit unused before it is closed
+        :param noop_after: sessions idle for longer than this are checked with NOOP before reuse
+        :param max_idle: maximum number of idle sessions kept per relay
+        :param timeout: connect/command timeout in seconds, same as the smtplib code
+        :param tracer: Tracer for the connect/login/send spans (and their timings in the metrics)
+        """
+        self._logger = logger
+        self.idle_timeout = idle_timeout
+        self.noop_after = noop_after
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self._idle = {}  # relay key -> list of (client, last_used)
+        self._tracer = tracer
+
+    async def send(self, relay, message):
+        """
+        :param relay: SMTPRelay to send through
+        :param message: EmailMessage
+        :return: True, SMTP_E, LOGIN_E or SENDM_E like OctoTextPlugin._send_email_message
+        """
+        while True:
+            client = await self._take(relay.key)
+            reused = client is not None
+            if client is None:
+                error, client = await self._connect(relay)
+                if error is not None:
+                    return error
+            try:
+                with self._span("smtp_send"):
+                    await client.send_message(message)
+            except (aiosmtplib.SMTPServerDisconnected, OSError) as e:
+                self._close(client)
+                if reused:
+                    self._logger.debug("Pooled SMTP session dropped (%s), reconnecting", e)
+                    continue
+                self._logger.exception(
+                    "Exception while sending through {relay}: {message}".format(
+                        relay=relay.name, message=str(e)
+                    )
+                )
+                return "SENDM_E"
+            except aiosmtplib.SMTPException as e:
+                self._close(client)
+                self._logger.exception(
+                    "Exception while sending through {relay}: {message}".format(
+                        relay=relay.name, message=str(e)
+                    )
+                )
+                return "SENDM_E"
+            idle = self._idle.setdefault(relay.key, [])
+            if len(idle) < self.max_idle:
+                idle.append((client, time.monotonic()))
+            else:
+                await self._quit(client)
+            return True
+
+    async def expire(self):
+        now = time.monotonic()
+        for key, idle in list(self._idle.items()):
+            keep = [(c, used) for c, used in idle if now - used <= self.idle_timeout]
+            for client, used in idle:
+                if now - used > self.idle_timeout:
+                    self._logger.debug("Closing idle SMTP session")
+                    await self._quit(client)
+            if keep:
+                self._idle[key] = keep
+            else:
+                del self._idle[key]
+
+    async def close_all(self):
+        idle = self._idle
+        self._idle = {}
+        for sessions in idle.values():
+            for client, _ in sessions:
+                await self._quit(client)
+
+    async def _take(self, key):
+        idle = self._idle.get(key)
+        while idle:
+            client, last_used = idle.pop()
+            if time.monotonic() - last_used < self.noop_after:
+                return client
+            try:
+                code = (await client.noop()).code
+            except (aiosmtplib.SMTPException, OSError):
+                code = -1
+            if code == 250:
+                return client
+            self._logger.debug("Pooled SMTP session failed NOOP (%s), reconnecting", code)
+            self._close(client)
+        return None
+
+    async def _connect(self, relay):
+        """
+        :return: [error, client] with the same error codes as OctoTextPlugin.smtp_login_server
+        """
+        client = aiosmtplib.SMTP(
+            hostname=relay.host,
+            port=relay.port,
+            use_tls=relay.use_ssl,
+            start_tls=not relay.use_ssl,
+            timeout=self.timeout,
+            # same as the smtplib code, aiosmtplib would verify the certificate otherwise
+            validate_certs=False,
+            tls_context=smtp_tls_context(),
+        )
+        try:
+            with self._span("smtp_connect"):
+                await client.connect()
+        except (aiosmtplib.SMTPException, OSError) as e:
+            self._close(client)
+            self._logger.exception(
+                "Exception while talking to your mail server {message}".format(message=str(e))
+            )
+            return ["SMTP_E", None]
+        # Only use SMTP auth if the password has been supplied, skip if blank - issue #91
+        if relay.password:
+            try:
+                with self._span("smtp_login"):
+                    await client.login(relay.login, relay.password)
+            except (aiosmtplib.SMTPException, OSError) as e:
+                self._logger.exception(
+                    "Exception while logging into mail server {message}".format(
+                        message=str(e)
+                    )
+                )
+                await self._quit(client)
+                return ["LOGIN_E", None]
+        return [None, client]
+
+    def _span(self, name):
+        if self._tracer is None:
+            return contextlib.nullcontext()
+        return self._tracer.span(name)
+
+    async def _quit(self, client):
+        try:
+            await client.quit()
+        except (aiosmtplib.SMTPException, OSError):
+            self._close(client)
+
+    @staticmethod
+    def _close(client):
+        try:
+            client.close()
+        except OSError:
+            pass
+
+
+class AsyncDeliveryEngine:
+    """
+    Event loop thread that takes over from email_message_queue_worker and snapshot_worker.
+    """
+
+    def __init__(
+        self,
+        logger,
+        queue,
+        prepare_queue,
+        begin,
+        send,
+        finish,
+        prepare,
+        startup=None,
+        idle=None,
+        shutdown=None,
+        max_in_flight=10,
+    ):
+        """
+        :param logger: logger for unexpected exceptions
+        :param queue: the NotificationQueue to deliver from
+        :param prepare_queue: queue.PriorityQueue of notifications waiting to be built
+        :param begin: notification -> notification to send or None, see OctoTextPlugin._begin_delivery
+        :param send: coroutine function (message, event class) -> result, see
+                     OctoTextPlugin._send_email_message_async
+        :param finish: (notification, result) -> None, see OctoTextPlugin._finish_delivery
+        :param prepare: blocking callable building and queueing one prepare_queue entry, runs in the thread
+                        pool
+        :param startup: blocking callable run in the thread pool before the first entry is prepared
+        :param idle: coroutine function called when there was nothing to send for a while
+        :param shutdown: coroutine function called after the last send, before the loop is closed
+        :param max_in_flight: maximum number of sends at the same time
+        """
+        self._logger = logger
+        self._queue = queue
+        self._prepare_queue = prepare_queue
+        self._begin = begin
+        self._send = send
+        self._finish = finish
+        self._prepare = prepare
+        self._startup = startup
+        self._idle = idle
+        self._shutdown = shutdown
+        self.max_in_flight = max(1, max_in_flight)
+        self._stopping = threading.Event()
+        self._tasks = set()
+        self._thread = None
+        self._loop = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=10):
+        """
+        Stop taking new work and wait up to timeout seconds for the sends in flight.
+        """
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def submit(self, coroutine_function):
+        """
+        Run coroutine_function() on the event loop, from any other thread. Does nothing when the loop isn't
+        running.
+        """
+        loop = self._loop
+        if loop is not None and loop.is_running():
+            asyncio.run_coroutine_threadsafe(coroutine_function(), loop)
+
+    def _run(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self._loop = loop
+        try:
+            loop.run_until_complete(self._main())
+        finally:
+            self._loop = None
+            loop.close()
+
+    async def _main(self):
+        self._slots = asyncio.Semaphore(self.max_in_flight)
+        await asyncio.gather(self._pump_notifications(), self._pump_prepare())
+        if self._tasks:
+            await asyncio.wait(self._tasks)
+        if self._shutdown is not None:
+            await self._shutdown()
+
+    def _spawn(self, coroutine):
+        # keep a reference, the loop only holds weak ones to running tasks
+        task = asyncio.ensure_future(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _pump_notifications(self):
+        loop = asyncio.get_running_loop()
+        while not self._stopping.is_set():
+            await self._slots.acquire()
+            try:
+                # short timeout so stop() is noticed, NotificationQueue has no asyncio interface
+                notification = await loop.run_in_executor(None, self._queue.get, 1.0)
+            except Empty:
+                self._slots.release()
+                if self._idle is not None:
+                    await self._idle()
+                continue
+            self._spawn(self._deliver(notification))
+
+    async def _deliver(self, notification):
+        try:
+            current = self._begin(notification)
+            if current is not None:
+                result = await self._send(current.message, current.event_class)
+                self._finish(current, result)
+        except Exception as e:
+            self._logger.exception(
+                "Exception while sending notification '{subject}': {message}".format(
+                    subject=notification.subject, message=str(e)
+                )
+            )
+        finally:
+            # other sends may take this provider's messages again
+            self._queue.done(notification)
+            self._slots.release()
+
+    async def _pump_prepare(self):
+        loop = asyncio.get_running_loop()
+        if self._startup is not None:
+            await loop.run_in_executor(None, self._startup)
+        while not self._stopping.is_set():
+            try:
+                job = await loop.run_in_executor(None, self._next_job)
+            except Empty:
+                continue
+            # snapshots and ffmpeg block, several notifications are built at the same time
+            self._spawn(loop.run_in_executor(None, self._prepare, job))
+
+    def _next_job(self):
+        return self._prepare_queue.get(timeout=1.0)
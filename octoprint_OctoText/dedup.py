@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+# Suppression of repeated notifications.
+#
+# OctoPrint and the printer both like to say things twice: Prusa firmware repeats "paused for user" every
+# couple of seconds while it waits, a progress percentage can be reported again after a pause, and a file
+# can be uploaded twice in a row by a slicer. Every duplicate used to cost a snapshot and a full SMTP round
+# trip (and a text message on somebody's phone).
+#
+# A notification is a duplicate when one with the same event type and file already went to the same
+# recipient within the suppression window of its event class. The window is counted from the notification
+# that got through, so a message repeated forever still goes out once per window. The check runs on the
+# event thread, before the snapshot is taken and anything is queued.
+#
+import threading
+import time
+
+# event class -> suppression window in seconds, 0 turns it off for the class. Can be changed with the
+# "dedup_windows" setting, "pause" also with the "Pause interval timeout" (mmu_timeout) on the settings page.
+DEFAULT_DEDUP_WINDOWS = {
+    "error": 60,
+    "fail": 10,
+    "cancel": 10,
+    "pause": 30,
+    "resume": 10,
+    "done": 10,
+    "start": 10,
+    "progress": 60,
+    "upload": 10,
+}
+
+
+class Deduplicator:
+    # forget keys once there are this many, only those older than the longest window
+    PRUNE_AT = 512
+
+    def __init__(self, windows):
+        """
+        :param windows: dict event class -> suppression window in seconds
+        """
+        self._lock = threading.Lock()
+        self._seen = {}  # (event type, file, recipient) -> time.monotonic() it was let through
+        self.suppressed = {}  # event class -> count
+        self.configure(windows)
+
+    def configure(self, windows):
+        with self._lock:
+            self.windows = dict(windows)
+            self._longest = max(self.windows.values(), default=0)
+
+    def admit(self, event_class, event_type, file, recipient):
+        """
+        :param event_class: notification class, selects the window
+        :param event_type: what happened, e.g. the OctoPrint event name or "progress 50"
+        :param file: the file it is about, None if none
+        :param recipient: anything hashable that tells the recipients apart
+        :return: False when this is a duplicate and should not be sent
+        """
+        window = self.windows.get(event_class, 0)
+        if window <= 0:
+            return True
+        key = (event_type, file, recipient)
+        now = time.monotonic()
+        with self._lock:
+            last = self._seen.get(key)
+            if last is not None and now - last < window:
+                self.suppressed[event_class] = self.suppressed.get(event_class, 0) + 1
+                return False
+            self._seen[key] = now
+            if len(self._seen) > self.PRUNE_AT:
+                self._seen = {
+                    k: seen for k, seen in self._seen.items() if now - seen < self._longest
+                }
+            return True
+
+    def clear(self):
+        with self._lock:
+            self._seen = {}
+
+    def snapshot(self):
+        """
+        :return: dict event class -> number of notifications suppressed
+        """
+        with self._lock:
+            return dict(self.suppressed)
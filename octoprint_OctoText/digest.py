@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+# Merge several queued notifications for the same destination into one message.
+#
+# When the queue backs up (network outage, rate limiting) there is no point in sending every event as its
+# own SMTP transaction and SMS. The worker pulls the other waiting messages for the same recipients and
+# sends them as a single digest. Only the newest progress update is kept, older ones are stale by the time
+# the digest goes out, and only the newest picture is attached.
+#
+from email.message import EmailMessage
+
+from .recipients import TRANSPORT_HEADER
+
+
+def destination_key(message):
+    """
+    Messages can only be merged when they go to exactly the same set of addresses (or push transport).
+    """
+    return (message[TRANSPORT_HEADER], message["To"], message["Cc"])
+
+
+def can_merge(message):
+    """
+    Only simple text messages (with an optional picture) are merged, anything fancier is sent as is.
+    """
+    if message.is_multipart() and message.get_content_type() != "multipart/mixed":
+        return False
+    return message.get_body(preferencelist=("plain",)) is not None
+
+
+def drop_stale_progress(notifications):
+    """
+    :param notifications: list of Notification in queue order
+    :return: (kept, superseded) - all progress updates except the newest one end up in superseded
+    """
+    progress = [n for n in notifications if n.event_class == "progress"]
+    superseded = progress[:-1]
+    kept = [n for n in notifications if n not in superseded]
+    return kept, superseded
+
+
+def build_digest(notifications):
+    """
+    :param notifications: list of Notification in queue order, all going to the same destination
+    :return: EmailMessage combining all of them
+    """
+    first = min(notifications, key=lambda n: n.sort_key())
+    message = EmailMessage()
+    for header in ("From", "To", "Cc", TRANSPORT_HEADER):
+        if first.message[header] is not None:
+            message[header] = first.message[header]
+    message["Date"] = notifications[-1].message["Date"]
+    message["Subject"] = f"{first.subject} (+{len(notifications) - 1} more)"
+
+    sections = []
+    for notification in notifications:
+        body = notification.message.get_body(preferencelist=("plain",))
+        text = body.get_content().strip() if body is not None else ""
+        sections.append(f"{notification.subject}\n{text}")
+    message.set_content("\n\n".join(sections), charset="utf-8")
+
+    # the newest picture is the most interesting one
+    for notification in reversed(notifications):
+        attachments = list(notification.message.iter_attachments())
+        if attachments:
+            attachment = attachments[0]
+            message.add_attachment(
+                attachment.get_content(),
+                maintype=attachment.get_content_maintype(),
+                subtype=attachment.get_content_subtype(),
+                filename=attachment.get_filename(),
+            )
+            break
+    return message
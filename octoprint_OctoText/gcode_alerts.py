@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+# Watch the lines received from the printer for messages worth a notification.
+#
+# The hook runs for every line the printer sends - temperature reports and "ok"s, thousands per minute - so
+# the common case has to be as cheap as possible: a single str.startswith() with a tuple of prefixes rejects
+# nearly every line before any regular expression runs. Everything the check needs is compiled once, when
+# the settings are loaded or saved.
+#
+# benchmarks/bench_gcode_filter.py measures the per-line cost.
+#
+import re
+
+# name -> alert definition. Users can add their own with the "gcode_alert_patterns" setting, same fields.
+#   prefix      - the line has to start with this (cheap pre-filter)
+#   pattern     - regular expression searched in the line once the prefix matched
+#   event_class - priority class of the notification, also decides which "en_" setting enables it
+#   title       - notification title
+# No alerts for "Error:" lines, OctoPrint already turns those into an ERROR event that on_event notifies.
+DEFAULT_ALERTS = {
+    # Prusa firmware when it waits for the user, e.g. filament run out or an MMU load failure
+    "paused_for_user": {
+        "prefix": "echo:busy: paused for user",
+        "pattern": r"paused for user",
+        "event_class": "pause",
+        "title": "Print Paused by printer",
+    },
+    # Marlin host action commands for a filament sensor trigger
+    "filament_runout": {
+        "prefix": "//action:",
+        "pattern": r"(?i)filament[ _]?runout|out of filament",
+        "event_class": "pause",
+        "title": "Filament runout detected",
+    },
+    "mmu_error": {
+        "prefix": ("MMU", "echo:MMU"),
+        "pattern": r"(?i)\b(error|fail(ed|ure)?|stuck|jam(med)?)\b",
+        "event_class": "error",
+        "title": "MMU error",
+    },
+}
+
+
+class GcodeAlert:
+    __slots__ = ("name", "prefixes", "regex", "event_class", "title")
+
+    def __init__(self, name, prefix, pattern, event_class, title):
+        self.name = name
+        self.prefixes = (prefix,) if isinstance(prefix, str) else tuple(prefix)
+        self.regex = re.compile(pattern)
+        self.event_class = event_class
+        self.title = title
+
+
+class AlertMatcher:
+    """
+    Compiled set of alerts. match() is what the gcode hook calls for every received line.
+    """
+
+    def __init__(self, alerts):
+        """
+        :param alerts: list of GcodeAlert
+        """
+        self.alerts = alerts
+        prefixes = set()
+        for alert in alerts:
+            prefixes.update(alert.prefixes)
+        # an empty tuple never matches, which is exactly right for "no alerts enabled"
+        self.prefixes = tuple(sorted(prefixes))
+
+    def match(self, line):
+        """
+        :return: the first GcodeAlert matching line, None for (nearly) every line
+        """
+        if not line.startswith(self.prefixes):
+            return None
+        for alert in self.alerts:
+            if line.startswith(alert.prefixes) and alert.regex.search(line):
+                return alert
+        return None
+
+    @classmethod
+    def from_settings(cls, enabled, custom, logger=None):
+        """
+        :param enabled: names of the DEFAULT_ALERTS to use
+        :param custom: list of dicts with name/prefix/pattern/event_class/title from the settings
+        :param logger: broken custom patterns are logged and skipped
+        """
+        alerts = []
+        for name in enabled or []:
+            definition = DEFAULT_ALERTS.get(name)
+            if definition is not None:
+                alerts.append(GcodeAlert(name, **definition))
+        for definition in custom or []:
+            try:
+                alerts.append(
+                    GcodeAlert(
+                        definition.get("name", definition["pattern"]),
+                        definition["prefix"],
+                        definition["pattern"],
+                        definition.get("event_class", "error"),
+                        definition.get("title", "Printer alert"),
+                    )
+                )
+            except (KeyError, TypeError, re.error) as e:
+                if logger is not None:
+                    logger.warning(f"Ignoring gcode alert pattern {definition}: {e}")
+        return cls(alerts)
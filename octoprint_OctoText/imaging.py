@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+# Rotating and flipping webcam snapshots to match the webcam settings.
+#
+# Starting ffmpeg for every snapshot just to rotate a JPEG costs hundreds of milliseconds and a good chunk
+# of memory on a Pi Zero/3. When Pillow is installed (pip install "OctoPrint-OctoText[pillow]") the image
+# is transformed in-process instead, ffmpeg is only used when Pillow is not available.
+# benchmarks/bench_image_transform.py compares the two.
+#
+# Snapshots never touch the disk: both paths take the jpeg as bytes and return the transformed bytes
+# (ffmpeg reads from stdin and writes to stdout), so there are no temp files wearing out the SD card.
+#
+# The same pass also shrinks the picture to fit the snapshot size limits. Many carrier MMS gateways reject
+# or slowly transcode anything over ~300 KB, which shows up as SENDM_E retries.
+#
+import io
+
+import sarge
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+if Image is not None:
+    # Pillow >= 9.1 moved the constants into an enum, older versions only have the module attributes
+    _Transpose = getattr(Image, "Transpose", Image)
+else:
+    _Transpose = None
+
+JPEG_QUALITY = 90
+# qualities tried, best first, when a picture has to fit into a byte budget
+BUDGET_QUALITIES = (85, 75, 65, 55, 45, 35)
+# ffmpeg's jpeg quality scale runs the other way: 2 is best, 31 is worst
+BUDGET_QSCALES = (4, 8, 14, 22, 31)
+
+
+def have_pillow():
+    return Image is not None
+
+
+def pillow_transform(data, rotate, hflip, vflip, max_side=0, max_bytes=0):
+    """
+    Rotate/flip and shrink the image with Pillow. Same order of operations as the ffmpeg filter chain:
+    rotate 90 degrees counter clockwise, then horizontal flip, then vertical flip.
+
+    :param data: jpeg image as bytes
+    :param max_side: longest side in pixels, 0 for no limit
+    :param max_bytes: size budget for the jpeg, 0 for no limit. Quality is lowered step by step, and the
+                      picture made smaller if that is not enough.
+    :return: transformed jpeg as bytes, data itself when nothing had to change
+    """
+    with Image.open(io.BytesIO(data)) as image:
+        too_large = max_side and max(image.size) > max_side
+        too_heavy = max_bytes and len(data) > max_bytes
+        if not (rotate or hflip or vflip or too_large or too_heavy):
+            return data
+
+        if rotate:
+            image = image.transpose(_Transpose.ROTATE_90)
+        if hflip:
+            image = image.transpose(_Transpose.FLIP_LEFT_RIGHT)
+        if vflip:
+            image = image.transpose(_Transpose.FLIP_TOP_BOTTOM)
+        image = image.convert("RGB")
+        if too_large:
+            image.thumbnail((max_side, max_side))
+
+        out = _encode(image, JPEG_QUALITY)
+        if not max_bytes or len(out) <= max_bytes:
+            return out
+        while True:
+            for quality in BUDGET_QUALITIES:
+                out = _encode(image, quality)
+                if len(out) <= max_bytes:
+                    return out
+            if min(image.size) < 64:
+                # give up, this is as small as it sensibly gets
+                return out
+            image = image.resize((image.width * 3 // 4, image.height * 3 // 4))
+
+
+def _encode(image, quality):
+    out = io.BytesIO()
+    image.save(out, "JPEG", quality=quality, optimize=True)
+    return out.getvalue()
+
+
+def ffmpeg_command(ffmpeg, rotate, hflip, vflip, pixfmt="yuv420p", max_side=0, qscale=None):
+    """
+    :param max_side: longest side in pixels, 0 for no limit
+    :param qscale: ffmpeg jpeg quality (2 best - 31 worst), None for ffmpeg's default
+    :return: the ffmpeg command line that rotates/flips a jpeg read from stdin and writes it to stdout
+    """
+    command = [ffmpeg, "-y", "-f", "image2pipe", "-i", "pipe:0"]
+
+    rotate_params = [f"format={pixfmt}"]  # workaround for foosel/OctoPrint#1317
+    if rotate:
+        rotate_params.append("transpose=2")  # 90 degrees counter clockwise
+    if hflip:
+        rotate_params.append("hflip")  # horizontal flip
+    if vflip:
+        rotate_params.append("vflip")  # vertical flip
+    if max_side:
+        # never scale up, the commas inside min() have to be escaped in a filter chain
+        rotate_params.append(
+            f"scale=w=min(iw\\,{max_side}):h=min(ih\\,{max_side})"
+            ":force_original_aspect_ratio=decrease"
+        )
+
+    command += [
+        "-vf",
+        # passed as a list, no shell involved, so the filter chain must not be shell quoted
+        ",".join(rotate_params),
+        "-f",
+        "image2pipe",
+        "-vcodec",
+        "mjpeg",
+    ]
+    if qscale is not None:
+        command += ["-q:v", str(qscale)]
+    command.append("pipe:1")
+    return command
+
+
+def ffmpeg_transform(
+    ffmpeg, data, rotate, hflip, vflip, pixfmt="yuv420p", max_side=0, qscale=None
+):
+    """
+    :param data: jpeg image as bytes
+    :return: the finished sarge pipeline, check returncode for success, the image is in stdout.bytes
+    """
+    return sarge.run(
+        ffmpeg_command(ffmpeg, rotate, hflip, vflip, pixfmt, max_side, qscale),
+        input=data,
+        stdout=sarge.Capture(),
+        stderr=sarge.Capture(),
+    )
@@ -0,0 +1,349 @@
+# -*- coding: utf-8 -*-
+# Simple in-memory counters for the notification queue, reported through the plugin API.
+#
+# Besides the totals there are histograms of the time from enqueue to delivery (per event class) and of
+# every step on the way (webcam snapshot, image processing, SMTP connect/login/send, push requests), so
+# it shows where the seconds go. The same numbers are served in the Prometheus text format, see
+# prometheus_text().
+#
+import bisect
+import threading
+
+# upper bounds of the histogram buckets in seconds. Delivery includes retries of a flaky mail server, the
+# steps are single network round trips or an ffmpeg run
+LATENCY_BUCKETS = (0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 900, 3600)
+STAGE_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# names of the steps timed with QueueMetrics.on_timing
+STAGES = (
+    "snapshot_fetch",
+    "image_pillow",
+    "image_ffmpeg",
+    "smtp_connect",
+    "smtp_login",
+    "smtp_send",
+    "push_send",
+)
+
+
+class Histogram:
+    """
+    Counts of observations per bucket, like a Prometheus histogram. Not thread safe, QueueMetrics holds
+    its lock around every call.
+    """
+
+    __slots__ = ("bounds", "counts", "total", "count")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # the last one is +Inf
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def snapshot(self):
+        """
+        :return: dict with the cumulative bucket counts as a list of [upper bound, count] (the last bound
+                 is "+Inf"), the number of observations and their sum
+        """
+        buckets = []
+        cumulative = 0
+        for bound, count in zip(self.bounds + ("+Inf",), self.counts):
+            cumulative += count
+            buckets.append([bound, cumulative])
+        return {"buckets": buckets, "count": self.count, "sum": self.total}
+
+
+class QueueMetrics:
+    """
+    Tracks how long messages sit in the notification queue and how long until they are delivered.
+    All times are in seconds.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.enqueued = 0
+            self.dequeued = 0
+            self.delivered = 0
+            self.failed = 0
+            self.rate_limited = 0
+            self.retries = 0
+            self.coalesced = 0
+            self.superseded = 0
+            self._wait_total = 0.0
+            self._wait_max = 0.0
+            self._latency_total = 0.0
+            self._latency_max = 0.0
+            self._latency_last = None
+            self._retries_by_error = {}
+            self._latency_by_event = {}
+            self._stages = {}
+
+    def on_enqueue(self):
+        with self._lock:
+            self.enqueued += 1
+
+    def on_dequeue(self, waited):
+        """
+        :param waited: time between enqueue and the worker picking the message up
+        """
+        with self._lock:
+            self.dequeued += 1
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+
+    def on_rate_limited(self):
+        with self._lock:
+            self.rate_limited += 1
+
+    def on_retry(self, error=None):
+        """
+        :param error: result code of the failed attempt (SMTP_E, LOGIN_E, SENDM_E, HTTP_E)
+        """
+        with self._lock:
+            self.retries += 1
+            error = error or "unknown"
+            self._retries_by_error[error] = self._retries_by_error.get(error, 0) + 1
+
+    def on_coalesced(self, count, superseded=0):
+        """
+        :param count: number of messages merged into a digest instead of being sent on their own
+        :param superseded: number of those left out because a newer progress update replaced them
+        """
+        with self._lock:
+            self.coalesced += count
+            self.superseded += superseded
+
+    def on_timing(self, stage, seconds):
+        """
+        :param stage: one of STAGES
+        :param seconds: how long the step took, failed attempts included
+        """
+        with self._lock:
+            histogram = self._stages.get(stage)
+            if histogram is None:
+                histogram = self._stages[stage] = Histogram(STAGE_BUCKETS)
+            histogram.observe(seconds)
+
+    def on_done(self, latency, success, event_class=None):
+        """
+        :param latency: time between enqueue and the final send attempt
+        :param success: True when the message was accepted by the mail server
+        :param event_class: notification class, the latency histograms are kept per class
+        """
+        with self._lock:
+            if success:
+                self.delivered += 1
+            else:
+                self.failed += 1
+            self._latency_total += latency
+            self._latency_max = max(self._latency_max, latency)
+            self._latency_last = latency
+            event_class = event_class or "other"
+            histogram = self._latency_by_event.get(event_class)
+            if histogram is None:
+                histogram = self._latency_by_event[event_class] = Histogram(LATENCY_BUCKETS)
+            histogram.observe(latency)
+
+    def snapshot(self, depth=None):
+        """
+        :param depth: current number of messages waiting in the queue
+        :return: dict of the current values, safe to hand to flask.jsonify
+        """
+        with self._lock:
+            picked_up = self.delivered + self.failed
+            return {
+                "queue_depth": depth,
+                "enqueued": self.enqueued,
+                "delivered": self.delivered,
+                "failed": self.failed,
+                "rate_limited": self.rate_limited,
+                "retries": self.retries,
+                "coalesced": self.coalesced,
+                "superseded": self.superseded,
+                "queue_wait_avg": self._wait_total / self.dequeued
+                if self.dequeued
+                else None,
+                "queue_wait_max": self._wait_max,
+                "latency_avg": self._latency_total / picked_up if picked_up else None,
+                "latency_max": self._latency_max,
+                "latency_last": self._latency_last,
+                "retries_by_error": dict(self._retries_by_error),
+                "latency_histograms": {
+                    event_class: histogram.snapshot()
+                    for event_class, histogram in self._latency_by_event.items()
+                },
+                "timings": {
+                    stage: histogram.snapshot() for stage, histogram in self._stages.items()
+                },
+            }
+
+
+# metrics dict key -> (metric name, type, help) for the plain numbers
+_PROMETHEUS_VALUES = (
+    (
+        "queue_depth",
+        "octotext_queue_depth",
+        "gauge",
+        "Notifications waiting to be sent",
+    ),
+    (
+        "waiting_retry",
+        "octotext_queue_waiting_retry",
+        "gauge",
+        "Notifications waiting for a retry or the rate limit",
+    ),
+    (
+        "queue_bytes",
+        "octotext_queue_bytes",
+        "gauge",
+        "Size of the queued notifications",
+    ),
+    (
+        "queue_dropped",
+        "octotext_queue_dropped_total",
+        "counter",
+        "Notifications dropped because the queue was full",
+    ),
+    (
+        "attachments_dropped",
+        "octotext_queue_attachments_dropped_total",
+        "counter",
+        "Notifications whose pictures were dropped because the queue was full",
+    ),
+    (
+        "enqueued",
+        "octotext_notifications_enqueued_total",
+        "counter",
+        "Notifications put on the queue",
+    ),
+    (
+        "delivered",
+        "octotext_notifications_delivered_total",
+        "counter",
+        "Notifications accepted by the server",
+    ),
+    (
+        "failed",
+        "octotext_notifications_failed_total",
+        "counter",
+        "Notifications given up on",
+    ),
+    (
+        "rate_limited",
+        "octotext_notifications_rate_limited_total",
+        "counter",
+        "Times a notification was held by the rate limit",
+    ),
+    (
+        "coalesced",
+        "octotext_notifications_coalesced_total",
+        "counter",
+        "Notifications merged into a digest",
+    ),
+    (
+        "superseded",
+        "octotext_notifications_superseded_total",
+        "counter",
+        "Progress notifications left out of a digest for a newer one",
+    ),
+    (
+        "snapshot_fetches",
+        "octotext_snapshot_fetches_total",
+        "counter",
+        "Pictures taken from the webcam",
+    ),
+    (
+        "snapshot_cache_hits",
+        "octotext_snapshot_cache_hits_total",
+        "counter",
+        "Webcam pictures shared between notifications",
+    ),
+    (
+        "thumbnail_cache_hits",
+        "octotext_thumbnail_cache_hits_total",
+        "counter",
+        "Print thumbnails found in the cache",
+    ),
+    (
+        "thumbnail_cache_misses",
+        "octotext_thumbnail_cache_misses_total",
+        "counter",
+        "Print thumbnails read from disk",
+    ),
+)
+
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _histogram_lines(lines, name, label, histograms):
+    for key, histogram in sorted(histograms.items()):
+        for bound, count in histogram["buckets"]:
+            lines.append(f'{name}_bucket{{{label}="{_label(key)}",le="{bound}"}} {count}')
+        lines.append(f'{name}_sum{{{label}="{_label(key)}"}} {histogram["sum"]}')
+        lines.append(f'{name}_count{{{label}="{_label(key)}"}} {histogram["count"]}')
+
+
+def prometheus_text(metrics):
+    """
+    :param metrics: dict from QueueMetrics.snapshot, plus the extra keys the plugin adds to it
+    :return: the metrics in the Prometheus text exposition format (version 0.0.4)
+    """
+    lines = []
+    for key, name, kind, text in _PROMETHEUS_VALUES:
+        value = metrics.get(key)
+        if value is None:
+            continue
+        lines.append(f"# HELP {name} {text}")
+        lines.append(f"# TYPE {name} {kind}")
+        lines.append(f"{name} {value}")
+
+    lines.append("# HELP octotext_retries_total Send attempts that will be retried, by error code")
+    lines.append("# TYPE octotext_retries_total counter")
+    for error, count in sorted(metrics.get("retries_by_error", {}).items()):
+        lines.append(f'octotext_retries_total{{error="{_label(error)}"}} {count}')
+
+    lines.append(
+        "# HELP octotext_dedup_suppressed_total Duplicate notifications not sent, by event class"
+    )
+    lines.append("# TYPE octotext_dedup_suppressed_total counter")
+    for event_class, count in sorted(metrics.get("dedup_suppressed", {}).items()):
+        lines.append(f'octotext_dedup_suppressed_total{{event="{_label(event_class)}"}} {count}')
+
+    lines.append(
+        "# HELP octotext_delivery_seconds Time from enqueue to the final send attempt, by event class"
+    )
+    lines.append("# TYPE octotext_delivery_seconds histogram")
+    _histogram_lines(
+        lines, "octotext_delivery_seconds", "event", metrics.get("latency_histograms", {})
+    )
+
+    lines.append("# HELP octotext_stage_seconds Time spent in each step of building and sending")
+    lines.append("# TYPE octotext_stage_seconds histogram")
+    _histogram_lines(lines, "octotext_stage_seconds", "stage", metrics.get("timings", {}))
+
+    relays = metrics.get("smtp_relays") or []
+    if relays:
+        lines.append("# HELP octotext_smtp_relay_up 1 while the relay is in rotation")
+        lines.append("# TYPE octotext_smtp_relay_up gauge")
+        for relay in relays:
+            lines.append(
+                f'octotext_smtp_relay_up{{relay="{_label(relay["relay"])}"}} {int(relay["healthy"])}'
+            )
+        lines.append("# HELP octotext_smtp_relay_sent_total Messages sent through the relay")
+        lines.append("# TYPE octotext_smtp_relay_sent_total counter")
+        for relay in relays:
+            lines.append(
+                f'octotext_smtp_relay_sent_total{{relay="{_label(relay["relay"])}"}} {relay["sent"]}'
+            )
+    return "\n".join(lines) + "\n"
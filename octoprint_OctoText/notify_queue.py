@@ -0,0 +1,368 @@
+# -*- coding: utf-8 -*-
+# The notification queue feeding email_message_queue_worker.
+#
+# Messages that fail with a retry-able error (or are held back by the rate limiter) are parked on a delay
+# heap instead of blocking the worker thread, so everything else in the queue keeps flowing while a
+# message waits for its next attempt. When a parked message comes due it goes back in line at its original
+# position, a retried message does not lose its place to messages that were queued after it.
+#
+# Notifications carry a priority (lower goes first) so a Printer ERROR! does not wait behind a backlog of
+# progress updates. Messages of the same priority are sent in the order they were queued.
+#
+# Several workers take messages from the same queue. A worker gets a message for a provider (the domain of
+# the destination) only if no other worker is busy with that provider, so messages to one gateway still go
+# out one at a time and in order, and a slow gateway only holds up its own messages.
+#
+# The queue is bounded by a number of messages and a number of bytes, during a long outage every
+# progress update with its webcam picture would otherwise pile up in the memory of a small Pi. What happens
+# to a new message when the queue is full is up to the overflow policy (OVERFLOW_POLICIES):
+#   drop_progress    - the oldest progress updates are dropped, newer ones make them stale anyway
+#   drop_attachments - pictures are taken off the queued messages, least important and oldest first
+#   block            - put() waits up to block_timeout seconds for the workers to make room
+# If that is not enough, the least important (and then oldest) message goes, which may be the new one.
+# Messages parked for a retry count towards the limits, but are never dropped or stripped to make room,
+# they were let in once already.
+#
+# Workers waiting in get() and put() calls waiting for room share one condition, so it is always
+# notify_all(): a notify() could wake a blocked put() and leave a worker idle next to a ready message.
+#
+import heapq
+import itertools
+import random
+import threading
+import time
+from queue import Empty
+
+from .recipients import destination_of, provider_of
+
+OVERFLOW_POLICIES = ("drop_progress", "drop_attachments", "block")
+
+# default send order of the notification classes, lower numbers are sent first. Can be changed with the
+# "priorities" setting.
+DEFAULT_PRIORITIES = {
+    "error": 0,
+    "fail": 0,
+    "cancel": 1,
+    "pause": 1,
+    "resume": 2,
+    "done": 2,
+    "api": 2,
+    "start": 3,
+    "progress": 4,
+    "upload": 5,
+}
+
+
+def message_size(message):
+    """
+    :return: approximate size of message in bytes, the encoded text and attachments without the headers
+    """
+    return sum(
+        len(part.get_payload() or "") for part in message.walk() if not part.is_multipart()
+    )
+
+
+def strip_images(message):
+    """
+    Take the pictures off message.
+
+    :return: True when there was something to take off
+    """
+    if not message.is_multipart():
+        return False
+    parts = message.get_payload()
+    keep = [part for part in parts if part.get_content_maintype() != "image"]
+    if len(keep) == len(parts):
+        return False
+    message.set_payload(keep)
+    return True
+
+
+class Notification:
+    """
+    A queued EmailMessage plus the bookkeeping needed to deliver it.
+    """
+
+    def __init__(self, message, priority=0, event_class=None):
+        self.message = message
+        self.priority = priority
+        self.event_class = event_class
+        self.subject = message["Subject"]
+        self.enqueued = time.monotonic()
+        self.dequeued = None
+        self.attempts = 0
+        self.seq = None
+        self.spool_id = None
+        self.destination = destination_of(message)
+        self.provider = provider_of(self.destination)
+        # notifications merged into this one (see digest.py), they are done when this one is
+        self.parts = []
+        self.size = message_size(message)
+        # tracing.Trace when this notification is one of the sampled ones
+        self.trace = None
+
+    def sort_key(self):
+        return (self.priority, self.seq)
+
+
+def backoff_delay(attempt, base, maximum, jitter=0.2):
+    """
+    Exponential backoff with jitter.
+
+    :param attempt: number of failed attempts so far (1 for the first retry)
+    :param base: delay before the first retry in seconds
+    :param maximum: upper bound for the delay in seconds
+    :param jitter: fraction of the delay to randomise by, so several printers don't retry in lock step
+    :return: seconds to wait before the next attempt
+    """
+    delay = min(maximum, base * (2 ** max(0, attempt - 1)))
+    return delay * random.uniform(1 - jitter, 1 + jitter)
+
+
+class NotificationQueue:
+    """
+    Queue of Notification objects with a delay heap for messages waiting to be retried.
+    """
+
+    def __init__(
+        self,
+        max_messages=0,
+        max_bytes=0,
+        overflow="drop_progress",
+        block_timeout=30,
+        on_drop=None,
+    ):
+        """
+        :param max_messages: limit for the number of queued messages, 0 for no limit
+        :param max_bytes: limit for the size of the queued messages (see message_size), 0 for no limit
+        :param overflow: one of OVERFLOW_POLICIES
+        :param block_timeout: longest wait of a put() with the block policy
+        :param on_drop: called with every notification dropped to make room, without the queue lock held
+        """
+        self._cond = threading.Condition()
+        self._ready = []  # heap of (sort key, notification)
+        self._delayed = []  # heap of (due time, seq, notification)
+        self._counter = itertools.count()
+        self._busy = set()  # providers a worker is sending to right now
+        self._bytes = 0
+        self._blocked = 0  # put() calls waiting for room
+        self._on_drop = on_drop
+        self.dropped = 0
+        self.stripped = 0
+        self.configure(max_messages, max_bytes, overflow, block_timeout)
+
+    def configure(self, max_messages=0, max_bytes=0, overflow="drop_progress", block_timeout=30):
+        with self._cond:
+            self.max_messages = max_messages
+            self.max_bytes = max_bytes
+            self.overflow = overflow if overflow in OVERFLOW_POLICIES else OVERFLOW_POLICIES[0]
+            self.block_timeout = block_timeout
+            # a put() blocked under the old limits may fit now
+            self._cond.notify_all()
+
+    def put(self, notification, block=True):
+        """
+        Queue a new notification, making room according to the overflow policy when the queue is full.
+
+        :param block: False to never wait, even with the block policy
+        """
+        dropped = []
+        with self._cond:
+            if notification.seq is None:
+                notification.seq = next(self._counter)
+            if self._full(notification):
+                self._make_room(notification, dropped, block)
+            if notification not in dropped:
+                heapq.heappush(self._ready, (notification.sort_key(), notification))
+                self._bytes += notification.size
+                self._cond.notify_all()
+        for notification in dropped:
+            if self._on_drop is not None:
+                self._on_drop(notification)
+
+    def put_delayed(self, notification, delay):
+        """
+        Park a notification until delay seconds from now.
+        """
+        with self._cond:
+            if notification.seq is None:
+                notification.seq = next(self._counter)
+            heapq.heappush(
+                self._delayed,
+                (time.monotonic() + delay, notification.seq, notification),
+            )
+            self._bytes += notification.size
+            self._cond.notify_all()
+
+    def get(self, timeout=None):
+        """
+        Wait for the next notification that is ready to be sent and whose provider is not busy. The
+        provider stays busy until the worker calls done().
+
+        :param timeout: seconds to wait, None waits forever
+        :return: Notification
+        :raises queue.Empty: when nothing became ready within timeout
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                self._promote(now)
+                notification = self._pop_idle()
+                if notification is not None:
+                    self._busy.add(notification.provider)
+                    self._taken([notification])
+                    return notification
+
+                wait = None if deadline is None else deadline - now
+                if self._delayed:
+                    due = self._delayed[0][0] - now
+                    wait = due if wait is None else min(wait, due)
+                if wait is not None and wait <= 0:
+                    raise Empty
+                self._cond.wait(wait)
+
+    def done(self, notification):
+        """
+        The worker is finished with notification (sent, parked for a retry or given up on), other
+        notifications for its provider can be handed out again.
+        """
+        with self._cond:
+            self._busy.discard(notification.provider)
+            self._cond.notify_all()
+
+    def _pop_idle(self):
+        if not self._busy:
+            return heapq.heappop(self._ready)[1] if self._ready else None
+        skipped = []
+        found = None
+        while self._ready:
+            entry = heapq.heappop(self._ready)
+            if entry[1].provider not in self._busy:
+                found = entry[1]
+                break
+            skipped.append(entry)
+        for entry in skipped:
+            heapq.heappush(self._ready, entry)
+        return found
+
+    def _promote(self, now):
+        while self._delayed and self._delayed[0][0] <= now:
+            notification = heapq.heappop(self._delayed)[2]
+            heapq.heappush(self._ready, (notification.sort_key(), notification))
+
+    def take_matching(self, predicate, limit):
+        """
+        Remove up to limit notifications that are ready to be sent and match predicate. Notifications parked
+        for a retry are left alone.
+
+        :return: list of Notification in the order they were queued
+        """
+        with self._cond:
+            self._promote(time.monotonic())
+            taken = []
+            keep = []
+            for entry in sorted(self._ready):
+                if len(taken) < limit and predicate(entry[1]):
+                    taken.append(entry[1])
+                else:
+                    keep.append(entry)
+            if taken:
+                self._ready = keep
+                heapq.heapify(self._ready)
+                self._taken(taken)
+        return sorted(taken, key=lambda n: n.seq)
+
+    def _taken(self, notifications):
+        self._bytes -= sum(n.size for n in notifications)
+        if self._blocked:
+            self._cond.notify_all()
+
+    def _full(self, notification):
+        count = len(self._ready) + len(self._delayed)
+        return (self.max_messages > 0 and count + 1 > self.max_messages) or (
+            self.max_bytes > 0 and self._bytes + notification.size > self.max_bytes
+        )
+
+    def _queued(self):
+        # the candidates for making room, notifications parked for a retry are left alone
+        return [entry[-1] for entry in self._ready]
+
+    def _make_room(self, notification, dropped, block):
+        """
+        Apply the overflow policy for notification, called with the lock held. Notifications taken out of
+        the queue (notification itself included) are added to dropped.
+        """
+        if self.overflow == "block" and block:
+            deadline = time.monotonic() + self.block_timeout
+            self._blocked += 1
+            try:
+                while self._full(notification):
+                    wait = deadline - time.monotonic()
+                    if wait <= 0:
+                        break
+                    self._cond.wait(wait)
+            finally:
+                self._blocked -= 1
+            if not self._full(notification):
+                return
+
+        if self.overflow == "drop_attachments":
+            # least important and oldest first, the new message last
+            for candidate in sorted(self._queued(), key=self._drop_order) + [notification]:
+                if not self._full(notification):
+                    return
+                if strip_images(candidate.message):
+                    size = message_size(candidate.message)
+                    if candidate is not notification:
+                        self._bytes -= candidate.size - size
+                    candidate.size = size
+                    self.stripped += 1
+
+        progress = sorted(
+            (n for n in self._queued() if n.event_class == "progress"),
+            key=lambda n: n.seq,
+        )
+        for victim in progress:
+            if not self._full(notification):
+                return
+            self._remove(victim)
+            dropped.append(victim)
+
+        while self._full(notification):
+            victim = max(self._queued() + [notification], key=self._drop_order)
+            dropped.append(victim)
+            if victim is notification:
+                # turned away, never queued, but dropped all the same
+                self.dropped += 1
+                return
+            self._remove(victim)
+
+    @staticmethod
+    def _drop_order(notification):
+        # the largest goes first: least important, then oldest
+        return (notification.priority, -notification.seq)
+
+    def _remove(self, notification):
+        self._ready = [entry for entry in self._ready if entry[-1] is not notification]
+        heapq.heapify(self._ready)
+        self._bytes -= notification.size
+        self.dropped += 1
+
+    def qsize(self):
+        with self._cond:
+            return len(self._ready) + len(self._delayed)
+
+    def waiting(self):
+        """
+        :return: number of notifications parked for a retry
+        """
+        with self._cond:
+            return len(self._delayed)
+
+    def nbytes(self):
+        """
+        :return: size of the queued notifications, see message_size
+        """
+        with self._cond:
+            return self._bytes
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+# Rate limiting for outgoing notifications.
+#
+# SMS gateways throttle (or silently drop) messages that arrive too quickly, this used to be handled by
+# sleeping a full minute after every message. A token bucket per destination lets a burst of events go out
+# right away and only spaces messages out once the burst allowance is used up.
+#
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    Classic token bucket: holds up to ``burst`` tokens and refills at ``rate`` tokens per second.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self._tokens = self.burst
+        self._stamp = time.monotonic()
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+
+    def reserve(self):
+        """
+        Take a token if one is available.
+
+        :return: 0 when a token was taken, otherwise the seconds until the next token is available
+        """
+        now = time.monotonic()
+        self._refill(now)
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0
+        if self.rate <= 0:
+            return float("inf")
+        return (1 - self._tokens) / self.rate
+
+
+class RateLimiter:
+    """
+    One TokenBucket per destination address, all sharing the same burst size and sustained rate.
+    """
+
+    def __init__(self, per_minute, burst):
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self.configure(per_minute, burst)
+
+    def configure(self, per_minute, burst):
+        """
+        Change the limits, existing buckets are dropped so they start again with a full burst.
+
+        :param per_minute: sustained messages per minute, 0 or less disables rate limiting
+        :param burst: number of messages that can be sent back to back
+        """
+        with self._lock:
+            self.rate = float(per_minute) / 60
+            self.burst = max(1, int(burst))
+            self._buckets = {}
+
+    def reserve(self, destination):
+        """
+        :param destination: address the message is going to
+        :return: 0 if the message can be sent now, otherwise seconds to wait before trying again
+        """
+        if self.rate <= 0:
+            return 0
+        with self._lock:
+            bucket = self._buckets.get(destination)
+            if bucket is None:
+                bucket = self._buckets[destination] = TokenBucket(self.rate, self.burst)
+            return bucket.reserve()
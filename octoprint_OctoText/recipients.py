@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+# Who gets which notification.
+#
+# Out of the box there is a single destination, phone_numb@carrier_address plus the addresses in cc_field.
+# The "recipients" setting replaces that with a list of addresses, each with its own list of event classes
+# (the names used in DEFAULT_PRIORITIES), so the night shift can get errors only while the owner gets
+# everything. Every recipient gets a message of its own: SMS gateways expect one number per message, and
+# the rate limiter, digests and retries all work per destination.
+#
+# Push transports (see transports.py) are recipients too. Their messages carry the transport name in the
+# TRANSPORT_HEADER header instead of a To address, which also survives the spool.
+#
+import copy
+
+TRANSPORT_HEADER = "X-OctoText-Transport"
+
+
+def destination_of(message):
+    """
+    :return: where message goes, the To header or "transport:<name>" for push transports
+    """
+    transport = message[TRANSPORT_HEADER]
+    if transport is not None:
+        return "transport:" + transport
+    return message["To"]
+
+
+def provider_of(address):
+    """
+    :param address: To header of a message, or a destination_of() value
+    :return: the lower case domain of address (the transport for push transports), notifications for one
+             provider are sent one at a time while different providers are served in parallel
+    """
+    if not address:
+        return ""
+    return str(address).rsplit("@", 1)[-1].strip(" >").lower()
+
+
+class Recipient:
+    __slots__ = ("address", "cc", "events", "transport")
+
+    def __init__(self, address, cc=None, events=None, transport=None):
+        """
+        :param address: destination, e.g. 8675309@mypixmessages.com
+        :param cc: list of addresses copied on every message to this recipient
+        :param events: event classes this recipient wants, None or empty for all of them
+        :param transport: name of the push transport, address is not used then
+        """
+        self.address = address
+        self.cc = cc
+        self.events = frozenset(events) if events else None
+        self.transport = transport
+
+    def wants(self, event_class):
+        return self.events is None or event_class is None or event_class in self.events
+
+    def address_message(self, message, copy_message=True):
+        """
+        :param message: EmailMessage without (or with someone else's) To/Cc headers
+        :param copy_message: False to address message itself, only for the last recipient of a message
+        :return: message addressed to this recipient
+        """
+        if copy_message:
+            # the attachments are already encoded strings, those are shared and not copied
+            message = copy.deepcopy(message)
+        del message["To"]
+        del message["Cc"]
+        del message[TRANSPORT_HEADER]
+        if self.transport is not None:
+            message[TRANSPORT_HEADER] = self.transport
+            return message
+        message["To"] = self.address
+        if self.cc:
+            message["Cc"] = self.cc
+        return message
+
+
+def recipients_from_settings(recipients, email_addr, cc_list, transports=None):
+    """
+    :param recipients: the "recipients" setting, list of dicts with address and optional events/cc lists
+    :param email_addr: phone_numb@carrier_address, used when there is no recipient list
+    :param cc_list: addresses from cc_field, copied on the email_addr messages
+    :param transports: the "transports" setting when push transports are enabled, each one is a recipient
+    :return: tuple of Recipient
+    """
+    result = []
+    for entry in recipients or []:
+        if not isinstance(entry, dict) or not entry.get("address"):
+            continue
+        result.append(
+            Recipient(
+                str(entry["address"]).strip(),
+                cc=entry.get("cc") or None,
+                events=entry.get("events"),
+            )
+        )
+    if not result:
+        result.append(Recipient(email_addr, cc=cc_list))
+    for entry in transports or []:
+        if isinstance(entry, dict) and entry.get("name"):
+            result.append(
+                Recipient(None, events=entry.get("events"), transport=str(entry["name"]))
+            )
+    return tuple(result)
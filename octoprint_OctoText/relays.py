@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+# Several SMTP relays for the notification workers.
+#
+# The relay on the settings page is the primary one, the "smtp_relays" setting adds more. A relay that
+# cannot be reached or refuses the login (SMTP_E/LOGIN_E) is taken out of rotation for a cool-down period,
+# doubling with every further failure, and the message goes out through the next relay straight away
+# instead of waiting for a retry. Healthy relays are picked in one of three ways:
+#   priority      - always the first healthy one in the list, the others are only fallbacks (default)
+#   round_robin   - take turns, spreads the sending quota over several accounts
+#   least_latency - the one with the fastest recent sends
+# When every relay is cooling down they are all tried anyway, soonest to recover first.
+#
+import threading
+import time
+
+STRATEGIES = ("priority", "round_robin", "least_latency")
+
+
+class SMTPRelay:
+    """
+    Connection and account details of one SMTP relay.
+    """
+
+    __slots__ = ("host", "port", "use_ssl", "login", "password", "from_addr")
+
+    def __init__(self, host, port, use_ssl, login, password, from_addr):
+        self.host = host
+        self.port = port
+        self.use_ssl = use_ssl
+        self.login = login
+        self.password = password
+        self.from_addr = from_addr
+
+    @property
+    def key(self):
+        # also the SMTPConnectionPool key, a changed password never reuses an old session
+        return (self.host, self.port, self.use_ssl, self.login, self.password)
+
+    @property
+    def name(self):
+        return f"{self.host}:{self.port}"
+
+
+def relays_from_settings(primary, extra):
+    """
+    :param primary: SMTPRelay built from the main settings
+    :param extra: the "smtp_relays" setting, list of dicts with smtp_name and optionally smtp_port, use_ssl,
+                  username, servername, validate_username and server_pass. Missing values are taken from
+                  the main settings.
+    :return: tuple of SMTPRelay, primary first
+    """
+    relays = [primary]
+    for entry in extra or []:
+        if not isinstance(entry, dict) or not entry.get("smtp_name"):
+            continue
+        if "username" in entry:
+            username = str(entry["username"])
+            address = username + "@" + str(entry.get("servername") or "")
+            login = username if entry.get("validate_username") else address
+            from_addr = login
+        else:
+            login = primary.login
+            from_addr = primary.from_addr
+        try:
+            port = int(entry.get("smtp_port", primary.port))
+        except (TypeError, ValueError):
+            continue
+        relays.append(
+            SMTPRelay(
+                str(entry["smtp_name"]),
+                port,
+                bool(entry.get("use_ssl", primary.use_ssl)),
+                login,
+                entry.get("server_pass", primary.password),
+                from_addr,
+            )
+        )
+    return tuple(relays)
+
+
+class _RelayHealth:
+    __slots__ = ("failures", "down_until", "latency", "sent", "last_error")
+
+    def __init__(self):
+        self.failures = 0
+        self.down_until = 0.0
+        self.latency = None  # moving average of the send time in seconds
+        self.sent = 0
+        self.last_error = None
+
+
+class RelaySelector:
+    """
+    Health tracking and selection for a list of SMTPRelay, shared by all worker threads.
+    """
+
+    def __init__(self, relays, strategy="priority", cooldown=30, max_cooldown=600):
+        """
+        :param relays: list of SMTPRelay, see relays_from_settings
+        :param strategy: one of STRATEGIES
+        :param cooldown: seconds a relay is skipped after its first failure, doubles with every further one
+        :param max_cooldown: upper limit for the cool-down in seconds
+        """
+        self._lock = threading.Lock()
+        self._health = {}
+        self._turn = 0
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.configure(relays, strategy)
+
+    def configure(self, relays, strategy):
+        """
+        Replace the relay list. Relays that are still in the list keep their health and latency history.
+        """
+        with self._lock:
+            self.relays = tuple(relays)
+            self.strategy = strategy if strategy in STRATEGIES else STRATEGIES[0]
+            self._health = {
+                relay.key: self._health.get(relay.key) or _RelayHealth()
+                for relay in self.relays
+            }
+
+    def candidates(self):
+        """
+        :return: list of SMTPRelay in the order they should be tried for the next message
+        """
+        now = time.monotonic()
+        with self._lock:
+            healthy = []
+            down = []
+            for relay in self.relays:
+                health = self._health[relay.key]
+                if health.down_until > now:
+                    down.append((health.down_until, relay))
+                else:
+                    healthy.append(relay)
+
+            if self.strategy == "round_robin" and healthy:
+                start = self._turn % len(healthy)
+                healthy = healthy[start:] + healthy[:start]
+                self._turn += 1
+            elif self.strategy == "least_latency":
+                # relays without a measurement yet go first so they get one
+                healthy.sort(key=lambda r: self._health[r.key].latency or 0.0)
+
+            return healthy + [relay for _, relay in sorted(down, key=lambda d: d[0])]
+
+    def on_success(self, relay, latency):
+        with self._lock:
+            health = self._health.get(relay.key)
+            if health is None:
+                return
+            health.failures = 0
+            health.down_until = 0.0
+            health.sent += 1
+            if health.latency is None:
+                health.latency = latency
+            else:
+                health.latency = 0.8 * health.latency + 0.2 * latency
+
+    def on_failure(self, relay, error):
+        """
+        :return: seconds the relay is taken out of rotation
+        """
+        with self._lock:
+            health = self._health.get(relay.key)
+            if health is None:
+                return 0
+            health.failures += 1
+            health.last_error = error
+            delay = min(self.max_cooldown, self.cooldown * 2 ** (health.failures - 1))
+            health.down_until = time.monotonic() + delay
+            return delay
+
+    def snapshot(self):
+        """
+        :return: list with the state of every relay, safe to hand to flask.jsonify
+        """
+        now = time.monotonic()
+        with self._lock:
+            return [
+                {
+                    "relay": relay.name,
+                    "healthy": self._health[relay.key].down_until <= now,
+                    "failures": self._health[relay.key].failures,
+                    "last_error": self._health[relay.key].last_error,
+                    "latency": self._health[relay.key].latency,
+                    "sent": self._health[relay.key].sent,
+                }
+                for relay in self.relays
+            ]
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+# Timer thread for everything the plugin does at a later time.
+#
+# Time based progress notifications used to get a thread of their own for every print, sharing one stop
+# Event between them, so a quick cancel and restart could leave two threads sending progress messages. One
+# heap of jobs served by one thread replaces that: starting a job under a key that is already in use
+# cancels the old job, and a cancelled job can not re-arm itself any more, even from inside its own
+# callback that happened to be running at the time.
+#
+import heapq
+import itertools
+import threading
+import time
+
+
+class Job:
+    """
+    Handle of a scheduled callback. The callback gets the job as its only argument.
+    """
+
+    __slots__ = ("key", "callback", "due", "seq", "cancelled")
+
+    def __init__(self, key, callback):
+        self.key = key
+        self.callback = callback
+        self.due = None
+        self.seq = None
+        self.cancelled = False
+
+
+class Scheduler:
+    """
+    Heap of Job objects ordered by due time, run one after the other on a single daemon thread. Callbacks
+    should be quick, anything slow belongs on one of the plugin's queues.
+    """
+
+    def __init__(self, logger):
+        self._logger = logger
+        self._cond = threading.Condition()
+        self._heap = []  # (due, seq, job) - entries whose seq is not job.seq any more are stale
+        self._jobs = {}  # key -> Job
+        self._counter = itertools.count()
+        self._thread = None
+        self._running = False
+
+    def start(self):
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            for job in self._jobs.values():
+                job.cancelled = True
+            self._jobs = {}
+            self._heap = []
+            self._cond.notify()
+
+    def schedule(self, key, delay, callback):
+        """
+        Run callback(job) in delay seconds. A job already scheduled under key is cancelled.
+
+        :return: Job
+        """
+        job = Job(key, callback)
+        with self._cond:
+            old = self._jobs.get(key)
+            if old is not None:
+                old.cancelled = True
+            self._jobs[key] = job
+            self._arm(job, delay)
+        return job
+
+    def reschedule(self, job, delay):
+        """
+        Move job (pending or currently running) to delay seconds from now.
+
+        :return: False when the job has been cancelled in the meantime
+        """
+        with self._cond:
+            if job.cancelled:
+                return False
+            self._jobs[job.key] = job
+            self._arm(job, delay)
+            return True
+
+    def cancel(self, key):
+        """
+        :return: True when there was a job for key
+        """
+        with self._cond:
+            job = self._jobs.pop(key, None)
+            if job is None:
+                return False
+            job.cancelled = True
+            return True
+
+    def pending(self, key):
+        with self._cond:
+            return key in self._jobs
+
+    def _arm(self, job, delay):
+        job.due = time.monotonic() + max(0, delay)
+        job.seq = next(self._counter)
+        heapq.heappush(self._heap, (job.due, job.seq, job))
+        self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                job = None
+                while self._running and job is None:
+                    # throw away cancelled jobs and entries superseded by a reschedule
+                    while self._heap and (
+                        self._heap[0][2].cancelled or self._heap[0][1] != self._heap[0][2].seq
+                    ):
+                        heapq.heappop(self._heap)
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+                    wait = self._heap[0][0] - time.monotonic()
+                    if wait > 0:
+                        self._cond.wait(wait)
+                        continue
+                    job = heapq.heappop(self._heap)[2]
+                    job.seq = None
+                if not self._running:
+                    return
+            # the job stays registered under its key while it runs, so cancel() reaches it
+            try:
+                job.callback(job)
+            except Exception as e:
+                self._logger.exception(
+                    "Exception in scheduled job {key}: {message}".format(
+                        key=job.key, message=str(e)
+                    )
+                )
+            with self._cond:
+                # a job that did not re-arm itself is finished
+                if job.seq is None and self._jobs.get(job.key) is job:
+                    del self._jobs[job.key]
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+# Read-only copy of the plugin settings for the notification paths.
+#
+# Every self._settings.get() walks OctoPrint's nested settings dicts and the defaults, and a single
+# notification used to do dozens of them (event handler, email builder, SMTP login). The snapshot is built
+# once at startup and again whenever settings are saved, everything else just reads attributes.
+#
+from .dedup import DEFAULT_DEDUP_WINDOWS
+from .notify_queue import DEFAULT_PRIORITIES
+from .recipients import recipients_from_settings
+from .relays import SMTPRelay, relays_from_settings
+
+
+def _to_bool(value):
+    if isinstance(value, str):
+        return value.strip().lower() in ("true", "yes", "on", "1")
+    return bool(value)
+
+
+def _to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _to_str(value):
+    return "" if value is None else str(value)
+
+
+def _raw(value):
+    return value
+
+
+# plugin setting -> conversion applied when the snapshot is built
+PLUGIN_FIELDS = {
+    "smtp_name": _to_str,
+    "smtp_port": _to_int,
+    "smtp_message": _to_str,
+    "username": _to_str,
+    "servername": _to_str,
+    "validate_username": _to_bool,
+    "server_pass": _raw,  # None means "no SMTP authentication"
+    "phone_numb": _to_str,
+    "carrier_address": _to_str,
+    "cc_field": _raw,
+    "recipients": _raw,
+    "push_message": _to_bool,
+    "transports": _raw,
+    "progress_interval": _to_int,
+    "en_progress_time": _to_bool,
+    "en_progress": _to_bool,
+    "en_webcam": _to_bool,
+    "en_printstart": _to_bool,
+    "en_printend": _to_bool,
+    "en_upload": _to_bool,
+    "en_error": _to_bool,
+    "en_printfail": _raw,  # False, "Fail" or "Cancel"
+    "en_printpaused": _to_bool,
+    "en_printresumed": _to_bool,
+    "show_fail_cancel": _to_bool,
+    "mmu_timeout": _to_int,
+    "use_ssl": _to_bool,
+    "smtp_relays": _raw,
+    "relay_strategy": _to_str,
+    "smtp_keepalive": _to_bool,
+    "smtp_idle_timeout": _to_int,
+    "send_workers": _to_int,
+    "delivery_engine": _to_str,
+    "async_max_in_flight": _to_int,
+    "rate_burst": _to_int,
+    "rate_per_minute": _to_float,
+    "retry_attempts": _to_int,
+    "retry_delay": _to_float,
+    "retry_max_delay": _to_float,
+    "en_spool": _to_bool,
+    "spool_max_messages": _to_int,
+    "spool_max_mb": _to_int,
+    "queue_max_messages": _to_int,
+    "queue_max_mb": _to_int,
+    "queue_overflow": _to_str,
+    "en_digest": _to_bool,
+    "digest_max": _to_int,
+    "image_backend": _to_str,
+    "snapshot_max_size": _to_int,
+    "snapshot_max_kb": _to_int,
+    "snapshot_cache_ttl": _to_float,
+    "thumbnail_cache_size": _to_int,
+    "thumbnail_max_size": _to_int,
+    "gcode_alerts": _raw,
+    "gcode_alert_patterns": _raw,
+    "trace_sample_rate": _to_float,
+    "trace_max_kb": _to_int,
+}
+
+# values from OctoPrint's own settings, or worked out from several plugin settings
+DERIVED_FIELDS = (
+    "printer_name",
+    "snapshot_url",
+    "webcam_flip_h",
+    "webcam_flip_v",
+    "webcam_rotate90",
+    "ffmpeg",
+    "priorities",
+    "dedup_windows",
+    "login",
+    "from_addr",
+    "email_addr",
+    "cc_list",
+    "recipient_list",
+    "relays",
+)
+
+
+class SettingsSnapshot:
+    """
+    Immutable settings values, one attribute per plugin setting plus the derived values in DERIVED_FIELDS.
+    """
+
+    __slots__ = tuple(PLUGIN_FIELDS) + DERIVED_FIELDS
+
+    def __init__(self, **values):
+        for name in self.__slots__:
+            object.__setattr__(self, name, values[name])
+
+    def __setattr__(self, name, value):
+        raise AttributeError("settings snapshot is read-only, rebuild it instead")
+
+    @classmethod
+    def from_settings(cls, settings):
+        """
+        :param settings: the plugin's octoprint.plugin.PluginSettings
+        """
+        values = {
+            name: convert(settings.get([name])) for name, convert in PLUGIN_FIELDS.items()
+        }
+
+        printer_name = settings.global_get(["appearance", "name"])
+        values["printer_name"] = printer_name if printer_name else "OctoText"
+        values["snapshot_url"] = settings.global_get(["webcam", "snapshot"])
+        values["webcam_flip_h"] = settings.global_get_boolean(["webcam", "flipH"])
+        values["webcam_flip_v"] = settings.global_get_boolean(["webcam", "flipV"])
+        values["webcam_rotate90"] = settings.global_get_boolean(["webcam", "rotate90"])
+        values["ffmpeg"] = settings.global_get(["webcam", "ffmpeg"])
+
+        priorities = dict(DEFAULT_PRIORITIES)
+        for event_class, priority in (settings.get(["priorities"]) or {}).items():
+            try:
+                priorities[event_class] = int(priority)
+            except (TypeError, ValueError):
+                pass
+        values["priorities"] = priorities
+
+        windows = dict(DEFAULT_DEDUP_WINDOWS)
+        for event_class, window in (settings.get(["dedup_windows"]) or {}).items():
+            try:
+                windows[event_class] = float(window)
+            except (TypeError, ValueError):
+                pass
+        # the pause timeout from the settings page, less than 30 seconds leaves it to dedup_windows. The printer's
+        # own pause alerts are then sent once per pause, see _on_gcode_alert
+        if values["mmu_timeout"] >= 30:
+            windows["pause"] = values["mmu_timeout"]
+        values["dedup_windows"] = windows
+
+        # only the username for servers that log in without the domain
+        address = values["username"] + "@" + values["servername"]
+        values["login"] = values["username"] if values["validate_username"] else address
+        values["from_addr"] = values["login"]
+        values["email_addr"] = values["phone_numb"] + "@" + values["carrier_address"]
+
+        cc_list = None
+        if values["cc_field"] is not None:
+            cc_list = values["cc_field"].replace("\n", "").replace(" ", "").split(",")
+        values["cc_list"] = cc_list
+        values["recipient_list"] = recipients_from_settings(
+            values["recipients"],
+            values["email_addr"],
+            cc_list,
+            values["transports"] if values["push_message"] else None,
+        )
+
+        primary = SMTPRelay(
+            values["smtp_name"],
+            values["smtp_port"],
+            values["use_ssl"],
+            values["login"],
+            values["server_pass"],
+            values["from_addr"],
+        )
+        values["relays"] = relays_from_settings(primary, values["smtp_relays"])
+        return cls(**values)
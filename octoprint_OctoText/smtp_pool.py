@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+# Keep-alive layer for the SMTP connections used by the notification worker.
+#
+# Opening an SMTP connection costs a TCP connect, a TLS handshake (STARTTLS or SSL) and an AUTH round trip.
+# On a Pi that is easily 1-3 seconds per message and providers like Outlook start throttling accounts that
+# log in over and over. The pool keeps authenticated sessions around between queued messages, checks them
+# with NOOP before reuse when they have been sitting for a while and closes them after an idle timeout.
+#
+import smtplib
+import ssl
+import threading
+import time
+
+
+def smtp_tls_context():
+    """
+    TLS settings for SSL and STARTTLS connections, shared by the smtplib and aiosmtplib code so both engines
+    accept the same servers. Certificates are not verified, which is what smtplib always did here: plenty
+    of users send through a router or a local relay with a self-signed certificate.
+    """
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+class SMTPConnectionPool:
+    """
+    Pool of authenticated SMTP sessions keyed by the connection parameters (host, port, ssl, login).
+
+    Connections are created by the ``connect`` callable handed to ``acquire`` so the pool does not need to
+    know anything about the plugin settings. A key change (new host, new password) simply never matches the
+    old idle sessions, which then age out through the idle timeout.
+    """
+
+    def __init__(self, logger, idle_timeout=120, noop_after=15, max_idle=2):
+        """
+        :param logger: logger used for debug output
+        :param idle_timeout: seconds a session may sit unused before it is closed
+        :param noop_after: sessions idle for longer than this are checked with NOOP before reuse
+        :param max_idle: maximum number of idle sessions kept per key
+        """
+        self._logger = logger
+        self.idle_timeout = idle_timeout
+        self.noop_after = noop_after
+        self.max_idle = max_idle
+        self._idle = {}  # key -> list of (connection, last_used)
+        self._lock = threading.Lock()
+
+    def acquire(self, key, connect):
+        """
+        Get a live session for key, reusing an idle one when possible.
+
+        :param key: hashable description of the server/account
+        :param connect: callable returning [error, connection] like OctoTextPlugin.smtp_login_server
+        :return: [error, connection, reused] - reused is True when the session came from the pool
+        """
+        self.expire()
+        while True:
+            with self._lock:
+                idle = self._idle.get(key)
+                if not idle:
+                    break
+                connection, last_used = idle.pop()
+            if time.monotonic() - last_used < self.noop_after or self._is_alive(
+                connection
+            ):
+                return [None, connection, True]
+            self._close(connection)
+
+        error, connection = connect()
+        return [error, connection, False]
+
+    def release(self, key, connection):
+        """
+        Hand a healthy session back to the pool after a successful send.
+        """
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append((connection, time.monotonic()))
+                return
+        self._close(connection)
+
+    def recycle(self, key, connection):
+        """
+        Hand a session back after the server refused a message. It is reset with RSET first, a session that
+        doesn't take that (421, hung up) is dropped.
+        """
+        try:
+            status = connection.rset()[0]
+        except (smtplib.SMTPException, OSError):
+            status = -1
+        if status == 250:
+            self.release(key, connection)
+        else:
+            self._logger.debug("SMTP session failed RSET (%s), dropping it", status)
+            self._close(connection)
+
+    def discard(self, connection):
+        """
+        Drop a session that failed, it is never handed out again.
+        """
+        self._close(connection)
+
+    def expire(self):
+        """
+        Close sessions that have been idle for longer than idle_timeout.
+        """
+        now = time.monotonic()
+        stale = []
+        with self._lock:
+            for key, idle in list(self._idle.items()):
+                keep = []
+                for connection, last_used in idle:
+                    if now - last_used > self.idle_timeout:
+                        stale.append(connection)
+                    else:
+                        keep.append((connection, last_used))
+                if keep:
+                    self._idle[key] = keep
+                else:
+                    del self._idle[key]
+        for connection in stale:
+            self._logger.debug("Closing idle SMTP session")
+            self._close(connection)
+
+    def close_all(self):
+        with self._lock:
+            idle = self._idle
+            self._idle = {}
+        for sessions in idle.values():
+            for connection, _ in sessions:
+                self._close(connection)
+
+    def _is_alive(self, connection):
+        try:
+            status = connection.noop()[0]
+        except (smtplib.SMTPException, OSError):
+            status = -1
+        if status != 250:
+            self._logger.debug("Pooled SMTP session failed NOOP (%s), reconnecting", status)
+            return False
+        return True
+
+    @staticmethod
+    def _close(connection):
+        try:
+            connection.quit()
+        except (smtplib.SMTPException, OSError):
+            try:
+                connection.close()
+            except OSError:
+                pass
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+# Share one webcam snapshot between notifications that fire close together.
+#
+# PRINT_DONE and the 100% progress event, or a pause and the "paused for user" line from the printer, tend
+# to arrive within a second or two of each other. Each of them would fetch and process its own snapshot.
+# The cache hands out the same (already processed) picture for a few seconds, and callers that ask while a
+# fetch is in progress wait for that fetch instead of starting their own. A failed fetch (the "webcam is
+# offline" picture) is only kept for a couple of seconds, long enough for the callers that waited for it, so
+# the camera is asked again as soon as it may be back.
+#
+import threading
+import time
+
+
+class SnapshotCache:
+    def __init__(self, ttl, failure_ttl=2):
+        """
+        :param ttl: seconds a snapshot is reused, 0 turns the cache off
+        :param failure_ttl: seconds a failed fetch is reused, never longer than ttl
+        """
+        self.ttl = ttl
+        self.failure_ttl = failure_ttl
+        self._lock = threading.Lock()
+        self._value = None
+        self._stamp = 0.0
+        self._value_ttl = 0.0
+        self._inflight = None  # threading.Event of the fetch in progress
+        self.hits = 0
+        self.fetches = 0
+
+    def get(self, fetch, failed=None):
+        """
+        :param fetch: callable doing the actual fetch, called at most once at a time
+        :param failed: value -> True when fetch returned a failure, those are kept for failure_ttl only
+        :return: whatever fetch returned, possibly for an earlier call
+        """
+        if self.ttl <= 0:
+            self.fetches += 1
+            return fetch()
+
+        while True:
+            with self._lock:
+                if (
+                    self._value is not None
+                    and time.monotonic() - self._stamp < self._value_ttl
+                ):
+                    self.hits += 1
+                    return self._value
+                inflight = self._inflight
+                if inflight is None:
+                    # we are the one doing the fetch
+                    self._inflight = done = threading.Event()
+                    break
+            # somebody else is fetching, wait for them and look again
+            inflight.wait()
+
+        try:
+            self.fetches += 1
+            value = fetch()
+            with self._lock:
+                self._value = value
+                self._stamp = time.monotonic()
+                self._value_ttl = self.ttl
+                if failed is not None and failed(value):
+                    self._value_ttl = min(self.ttl, self.failure_ttl)
+            return value
+        finally:
+            with self._lock:
+                self._inflight = None
+            done.set()
+
+    def clear(self):
+        with self._lock:
+            self._value = None
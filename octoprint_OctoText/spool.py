@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+# On-disk copy of the notification queue.
+#
+# Every queued message is also written to a small SQLite database in the plugin data folder and removed
+# again once it has been handled or has run out of retries. The snapshot worker spools a text only copy
+# before it fetches the webcam picture and replaces it with the finished message, one row per message. Whatever is still in there when OctoPrint starts up (after a
+# restart or reboot during a network outage) is put back on the queue.
+#
+# The database runs in WAL mode with synchronous=NORMAL so individual inserts/deletes are not fsync'd, the
+# WAL is synced in batches at checkpoints. That keeps SD card writes down at the cost of possibly losing the
+# last few messages on a power cut, which is an acceptable trade for notifications.
+#
+import email
+import email.policy
+import sqlite3
+import threading
+import time
+
+
+class NotificationSpool:
+    """
+    SQLite backed spool of queued EmailMessages.
+    """
+
+    def __init__(self, path, logger, max_messages=200, max_bytes=20 * 1024 * 1024):
+        """
+        :param path: database file
+        :param logger: logger for warnings about dropped messages
+        :param max_messages: oldest, least important messages are dropped above this count
+        :param max_bytes: ... or above this total message size
+        """
+        self._logger = logger
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._deletes = 0
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        # auto_vacuum has to be set before the first table is created to take effect
+        self._db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS spool ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " created REAL NOT NULL,"
+            " priority INTEGER NOT NULL,"
+            " event_class TEXT,"
+            " size INTEGER NOT NULL,"
+            " message BLOB NOT NULL)"
+        )
+
+    def add(self, message, priority=0, event_class=None):
+        """
+        :param message: EmailMessage to store
+        :return: row id used to remove the message later
+        """
+        data = message.as_bytes()
+        with self._lock:
+            spool_id = self._insert(data, priority, event_class)
+            self._enforce_limits()
+            return spool_id
+
+    def update(self, spool_id, message, priority=0, event_class=None):
+        """
+        Replace the message stored under spool_id.
+
+        :return: row id of the message, a new one when the old row was dropped to make room meanwhile
+        """
+        data = message.as_bytes()
+        with self._lock:
+            cursor = self._db.execute(
+                "UPDATE spool SET size = ?, message = ? WHERE id = ?",
+                (len(data), data, spool_id),
+            )
+            if cursor.rowcount == 0:
+                spool_id = self._insert(data, priority, event_class)
+            self._enforce_limits()
+            return spool_id
+
+    def _insert(self, data, priority, event_class):
+        cursor = self._db.execute(
+            "INSERT INTO spool (created, priority, event_class, size, message)"
+            " VALUES (?, ?, ?, ?, ?)",
+            (time.time(), priority, event_class, len(data), data),
+        )
+        return cursor.lastrowid
+
+    def remove(self, spool_id):
+        with self._lock:
+            self._db.execute("DELETE FROM spool WHERE id = ?", (spool_id,))
+            self._deletes += 1
+            if self._deletes >= 50:
+                self._compact()
+
+    def load(self):
+        """
+        :return: list of (id, created, priority, event_class, EmailMessage) in the order they were queued
+        """
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, created, priority, event_class, message FROM spool ORDER BY id"
+            ).fetchall()
+        entries = []
+        for spool_id, created, priority, event_class, data in rows:
+            message = email.message_from_bytes(data, policy=email.policy.default)
+            entries.append((spool_id, created, priority, event_class, message))
+        return entries
+
+    def compact(self):
+        with self._lock:
+            self._compact()
+
+    def close(self):
+        with self._lock:
+            self._compact()
+            self._db.close()
+
+    def _enforce_limits(self):
+        count, size = self._db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM spool"
+        ).fetchone()
+        dropped = 0
+        while count > self.max_messages or size > self.max_bytes:
+            # throw away the least important message, oldest first
+            spool_id, row_size = self._db.execute(
+                "SELECT id, size FROM spool ORDER BY priority DESC, id LIMIT 1"
+            ).fetchone()
+            self._db.execute("DELETE FROM spool WHERE id = ?", (spool_id,))
+            count -= 1
+            size -= row_size
+            dropped += 1
+        if dropped:
+            self._deletes += dropped
+            self._logger.warning(
+                f"Notification spool is full, dropped {dropped} message(s) from disk"
+            )
+
+    def _compact(self):
+        # give the pages of deleted messages back to the filesystem and fold the WAL into the database
+        self._db.execute("PRAGMA incremental_vacuum")
+        self._db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        self._deletes = 0
@@ -50,6 +50,8 @@ $(function() {
                             text = gettext("Exception while logging into mail server. Check your login and password.");
                         } else if (response.error === "SMTP_E"){
                             text = gettext("Exception while talking to your mail server, check your SMTP settings.");
+                        } else if (response.error === "HTTP_E" || response.error === "HTTP_REFUSED"){
+                            text = gettext("A push service did not take the message, check your transports settings.");
                         } else {
                             text = gettext("Test message could not be sent, check log & your settings");
                         }
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+# Index of the thumbnails made by the PrusaSlicer Thumbnails and Cura Thumbnails plugins.
+#
+# Both plugins keep a png next to where the gcode would be in their own data folder, e.g. the thumbnail for
+# "parts/bracket.gcode" is "<plugin data>/parts/bracket.png". Instead of probing both folders on every
+# upload and print start the index is built once at startup and then kept up to date: file events only
+# touch the in-memory index, the disk is only looked at again (from the snapshot worker, never from the
+# event thread) for a file the index knows nothing about.
+#
+import io
+import os
+import posixpath
+import re
+import threading
+from collections import OrderedDict
+from email.message import MIMEPart
+
+from . import imaging
+
+GCODE_EXTENSIONS = re.compile(r"\.(gcode|gco|g|bgcode)$", re.IGNORECASE)
+
+
+def thumbnail_key(path):
+    """
+    :param path: gcode path relative to the storage root ("parts/bracket.gcode") or a thumbnail path
+                 relative to a thumbnail folder ("parts/bracket.png")
+    :return: the path without extension, used as the index key ("parts/bracket")
+    """
+    path = path.replace(os.sep, "/").lstrip("/")
+    if path.lower().endswith(".png"):
+        return path[:-4]
+    return GCODE_EXTENSIONS.sub("", path)
+
+
+class ThumbnailIndex:
+    def __init__(self, folders):
+        """
+        :param folders: thumbnail folders, in order of preference
+        """
+        self.folders = [f for f in folders if f]
+        self._lock = threading.Lock()
+        self._by_path = {}  # key -> (thumbnail path, mtime)
+        self._by_name = {}  # basename of key -> (thumbnail path, mtime), for callers with only a file name
+
+    def build(self):
+        """
+        Scan the thumbnail folders. Folders listed first win when both have a thumbnail for the same file.
+        :return: number of thumbnails found
+        """
+        by_path = {}
+        by_name = {}
+        for folder in reversed(self.folders):
+            if not os.path.isdir(folder):
+                continue
+            for root, _, files in os.walk(folder):
+                for name in files:
+                    if not name.lower().endswith(".png"):
+                        continue
+                    full = os.path.join(root, name)
+                    try:
+                        entry = (full, os.path.getmtime(full))
+                    except OSError:
+                        continue
+                    key = thumbnail_key(os.path.relpath(full, folder))
+                    by_path[key] = entry
+                    by_name[posixpath.basename(key)] = entry
+        with self._lock:
+            self._by_path = by_path
+            self._by_name = by_name
+        return len(by_path)
+
+    def get(self, path):
+        """
+        In-memory lookup only. A bare file name (no folder) is matched by name in any folder, a path only
+        ever matches the thumbnail for that path - another folder's file of the same name is a different print.
+
+        :param path: gcode path relative to the storage root, or just the file name
+        :return: (thumbnail path, mtime) or None
+        """
+        key = thumbnail_key(path)
+        with self._lock:
+            entry = self._by_path.get(key)
+            if entry is None and "/" not in key:
+                entry = self._by_name.get(key)
+        return entry
+
+    def lookup(self, path):
+        """
+        Like get, but when the index has no thumbnail for path the thumbnail folders are checked for it once
+        more, the thumbnail plugins may have written it after the index last looked. Don't call this on the
+        event thread.
+
+        :return: (thumbnail path, mtime) or None
+        """
+        key = thumbnail_key(path)
+        with self._lock:
+            entry = self._by_path.get(key)
+        if entry is not None:
+            return entry
+        for folder in self.folders:
+            full = os.path.join(folder, *(key + ".png").split("/"))
+            try:
+                entry = (full, os.path.getmtime(full))
+            except OSError:
+                continue
+            with self._lock:
+                self._by_path[key] = entry
+                self._by_name[posixpath.basename(key)] = entry
+            return entry
+        # the caller only knows the file name, any folder will do
+        return self.get(path)
+
+    def forget(self, path):
+        """
+        A gcode file was added, changed or removed, drop what we know about its thumbnail.
+        """
+        key = thumbnail_key(path)
+        name = posixpath.basename(key)
+        with self._lock:
+            entry = self._by_path.pop(key, None)
+            if entry is not None and self._by_name.get(name) == entry:
+                del self._by_name[name]
+
+    def forget_folder(self, path):
+        prefix = thumbnail_key(path).rstrip("/") + "/"
+        with self._lock:
+            for key in [k for k in self._by_path if k.startswith(prefix)]:
+                entry = self._by_path.pop(key)
+                name = posixpath.basename(key)
+                if self._by_name.get(name) == entry:
+                    del self._by_name[name]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._by_path)
+
+
+class ThumbnailPartCache:
+    """
+    Bounded LRU of ready-to-attach MIME parts for thumbnails, keyed by (path, mtime).
+
+    Print farms reprint the same files all day. With the part cached a print start notification is built
+    without reading the png or base64 encoding it again. A new thumbnail for the same file has a new mtime,
+    so the stale part simply ages out.
+    """
+
+    def __init__(self, maxsize=32, max_side=0):
+        """
+        :param maxsize: number of parts kept
+        :param max_side: thumbnails larger than this (longest side, pixels) are scaled down when Pillow is
+                         installed, 0 keeps them as they are
+        """
+        self.maxsize = maxsize
+        self.max_side = max_side
+        self._lock = threading.Lock()
+        self._parts = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, entry):
+        """
+        :param entry: (thumbnail path, mtime) as returned by ThumbnailIndex
+        :return: MIMEPart with the png as attachment
+        :raises OSError: when the file can't be read
+        """
+        key = (entry[0], entry[1], self.max_side)
+        with self._lock:
+            part = self._parts.get(key)
+            if part is not None:
+                self._parts.move_to_end(key)
+                self.hits += 1
+                return part
+
+        with open(entry[0], "rb") as fp:
+            data = fp.read()
+        data = self._shrink(data)
+        part = MIMEPart()
+        part.set_content(
+            data,
+            maintype="image",
+            subtype="png",
+            disposition="attachment",
+            filename=os.path.basename(entry[0]),
+        )
+
+        with self._lock:
+            self.misses += 1
+            self._parts[key] = part
+            while len(self._parts) > self.maxsize:
+                self._parts.popitem(last=False)
+        return part
+
+    def clear(self):
+        with self._lock:
+            self._parts.clear()
+
+    def _shrink(self, data):
+        if not self.max_side or not imaging.have_pillow():
+            return data
+        with imaging.Image.open(io.BytesIO(data)) as image:
+            if max(image.size) <= self.max_side:
+                return data
+            image.thumbnail((self.max_side, self.max_side))
+            out = io.BytesIO()
+            image.save(out, "PNG", optimize=True)
+        return out.getvalue()
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+# Per-notification traces: how long each step took, from the OctoPrint event to the last send attempt.
+#
+# With "trace_sample_rate" above 0 that share of the events gets a Trace, which travels with the
+# notification through _prepareQ, the notification queue and the retries. The code marks its steps with
+# Tracer.span(), which records into the trace of the current context. The trace is a ContextVar, so it
+# follows the notification into whatever worker thread or asyncio task is busy with it, as long as the
+# worker activates it. Finished traces are appended as JSON lines to traces.jsonl in the plugin data folder.
+#
+# Tracing is off by default and has to cost next to nothing then: span() does one ContextVar lookup and
+# hands back a shared do-nothing context manager. Only the steps that feed the timing histograms in
+# metrics.py (STAGES) are always timed.
+#
+import contextvars
+import functools
+import itertools
+import json
+import os
+import random
+import threading
+import time
+
+from .metrics import STAGES
+
+_current = contextvars.ContextVar("octotext_trace", default=None)
+
+
+class _NoSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+class Trace:
+    """
+    Spans of one event, shared by all notifications (recipients) it turned into.
+    """
+
+    _ids = itertools.count(1)
+
+    def __init__(self, name):
+        self.id = next(self._ids)
+        self.name = name
+        self.wall = time.time()
+        self.started = time.monotonic()
+        self.spans = []
+        self.results = []
+        # notifications still working on this trace, it is written out when the last one is done
+        self.pending = 0
+        self._lock = threading.Lock()
+
+    def add(self, name, started, duration, error=None):
+        span = {
+            "name": name,
+            "start": round(started - self.started, 6),
+            "duration": round(duration, 6),
+            "thread": threading.current_thread().name,
+        }
+        if error is not None:
+            span["error"] = error
+        with self._lock:
+            self.spans.append(span)
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "id": self.id,
+                "event": self.name,
+                "time": self.wall,
+                "total": round(time.monotonic() - self.started, 6),
+                "results": list(self.results),
+                "spans": sorted(self.spans, key=lambda span: span["start"]),
+            }
+
+
+class _Span:
+    __slots__ = ("_tracer", "_trace", "_name", "_started")
+
+    def __init__(self, tracer, trace, name):
+        self._tracer = tracer
+        self._trace = trace
+        self._name = name
+
+    def __enter__(self):
+        self._started = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.monotonic() - self._started
+        if self._name in STAGES and self._tracer.metrics is not None:
+            self._tracer.metrics.on_timing(self._name, duration)
+        if self._trace is not None:
+            self._trace.add(
+                self._name,
+                self._started,
+                duration,
+                None if exc_type is None else exc_type.__name__,
+            )
+        return False
+
+
+class _Activation:
+    __slots__ = ("_trace", "_token")
+
+    def __init__(self, trace):
+        self._trace = trace
+
+    def __enter__(self):
+        self._token = _current.set(self._trace)
+        return self._trace
+
+    def __exit__(self, *exc_info):
+        _current.reset(self._token)
+        return False
+
+
+class Tracer:
+    def __init__(self, folder, sample_rate=0.0, max_kb=1024, metrics=None):
+        """
+        :param folder: where traces.jsonl is written
+        :param sample_rate: share of the events that are traced, 0 for none and 1 for all of them
+        :param max_kb: size at which traces.jsonl is moved to traces.jsonl.1 and a new file is started
+        :param metrics: QueueMetrics that gets the timings of the STAGES steps, traced or not
+        """
+        self.path = os.path.join(folder, "traces.jsonl")
+        self.sample_rate = sample_rate
+        self.max_kb = max_kb
+        self.metrics = metrics
+        self.written = 0
+        self._lock = threading.Lock()
+
+    def start(self, name):
+        """
+        :param name: what is being traced, e.g. the event name
+        :return: a new Trace for a sampled event, None otherwise
+        """
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return None
+        return Trace(name)
+
+    @staticmethod
+    def current():
+        return _current.get()
+
+    @staticmethod
+    def activate(trace):
+        """
+        Make trace the current trace for the with block, trace may be None.
+        """
+        return _Activation(trace)
+
+    @staticmethod
+    def attach(trace):
+        """
+        Make trace the current trace until the end of the current context. Only for code that runs in a
+        context of its own, like an asyncio task.
+        """
+        _current.set(trace)
+
+    @staticmethod
+    def bind(func, *args):
+        """
+        :return: callable running func(*args) with the current trace, for handing work to a thread pool
+        """
+        if _current.get() is None:
+            return functools.partial(func, *args)
+        return functools.partial(contextvars.copy_context().run, func, *args)
+
+    def span(self, name):
+        """
+        Time the with block as step name of the current trace.
+        """
+        trace = _current.get()
+        if trace is None and name not in STAGES:
+            return _NO_SPAN
+        return _Span(self, trace, name)
+
+    def hold(self, trace):
+        """
+        One more notification works on trace, it is written out after a matching finish().
+        """
+        if trace is not None:
+            with trace._lock:
+                trace.pending += 1
+
+    def finish(self, trace, result):
+        """
+        :param result: how one of the notifications of trace ended (True or an error code), None for a
+                       hold() that wasn't a notification
+        """
+        if trace is None:
+            return
+        with trace._lock:
+            if result is not None:
+                trace.results.append(result)
+            trace.pending -= 1
+            if trace.pending > 0:
+                return
+        self._write(trace.to_dict())
+
+    def _write(self, record):
+        line = json.dumps(record, default=str) + "\n"
+        with self._lock:
+            try:
+                if (
+                    os.path.exists(self.path)
+                    and os.path.getsize(self.path) > self.max_kb * 1024
+                ):
+                    os.replace(self.path, self.path + ".1")
+                with open(self.path, "a", encoding="utf-8") as fp:
+                    fp.write(line)
+                self.written += 1
+            except OSError:
+                # traces are a debugging aid, never let them get in the way of a notification
+                pass
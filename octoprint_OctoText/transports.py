@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+# Push and webhook transports, delivered next to (or instead of) the SMS/email gateway.
+#
+# A text through an email-to-SMS gateway can take minutes to arrive, push services are there in seconds.
+# Entries in the "transports" setting become extra recipients (see recipients.py), each with its own list
+# of events. The message is built exactly like an email and goes through the same queue, spool, digest and
+# retry code, only the last step hands it to one of these instead of an SMTP relay:
+#   webhook  - POST of a JSON document (title, message, event, image as base64) to any URL
+#   ntfy     - ntfy.sh or a self-hosted ntfy server, the picture is sent as attachment
+#   pushover - the Pushover message API, the picture is sent as attachment
+#   matrix   - text message to a Matrix room
+# Every transport keeps a requests Session so the TCP/TLS connection stays open between messages. All of
+# the URLs can be set, that is also how a transport is pointed at a local stand-in server for testing.
+#
+import base64
+import itertools
+import time
+from email.header import Header
+from urllib.parse import quote
+
+import requests
+
+# result codes, like SMTP_E & co. HTTP_E is retried, HTTP_REFUSED (bad token, unknown topic) is not
+HTTP_E = "HTTP_E"
+HTTP_REFUSED = "HTTP_REFUSED"
+
+
+def message_parts(message):
+    """
+    :param message: EmailMessage built by the plugin (or handed over by another plugin)
+    :return: (title, text, image) - image is (data, content type, filename) or None
+    """
+    title = str(message["Subject"] or "")
+    body = message.get_body(preferencelist=("plain",))
+    text = body.get_content().strip() if body is not None else ""
+    image = None
+    for attachment in message.iter_attachments():
+        if attachment.get_content_maintype() == "image":
+            image = (
+                attachment.get_content(),
+                attachment.get_content_type(),
+                attachment.get_filename() or "snapshot.jpg",
+            )
+            break
+    return title, text, image
+
+
+class Transport:
+    """
+    Base class, subclasses implement _request().
+    """
+
+    def __init__(self, name, logger, timeout=10):
+        self.name = name
+        self.timeout = timeout
+        self._logger = logger
+        self._session = None
+
+    @property
+    def session(self):
+        if self._session is None:
+            self._session = requests.Session()
+        return self._session
+
+    def send(self, message, event_class=None):
+        """
+        :param message: EmailMessage to deliver
+        :param event_class: notification class, some services map it to their priority levels
+        :return: True, HTTP_E (try again later) or HTTP_REFUSED (won't work on a retry either)
+        """
+        title, text, image = message_parts(message)
+        try:
+            response = self._request(title, text, image, event_class)
+        except requests.RequestException as e:
+            self._logger.exception(
+                "Exception while sending to {name}: {message}".format(
+                    name=self.name, message=str(e)
+                )
+            )
+            return HTTP_E
+        if response.status_code >= 400:
+            self._logger.error(
+                f"{self.name} refused the notification: {response.status_code} {response.text[:200]}"
+            )
+            if response.status_code == 429 or response.status_code >= 500:
+                return HTTP_E
+            return HTTP_REFUSED
+        return True
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+
+    def _request(self, title, text, image, event_class):
+        raise NotImplementedError()
+
+
+class WebhookTransport(Transport):
+    def __init__(self, name, logger, url, headers=None, timeout=10):
+        Transport.__init__(self, name, logger, timeout)
+        self.url = url
+        self.headers = headers or {}
+
+    def _request(self, title, text, image, event_class):
+        document = {"title": title, "message": text, "event": event_class}
+        if image is not None:
+            document["image"] = base64.b64encode(image[0]).decode("ascii")
+            document["image_type"] = image[1]
+        return self.session.post(
+            self.url, json=document, headers=self.headers, timeout=self.timeout
+        )
+
+
+class NtfyTransport(Transport):
+    # event class -> ntfy priority (1 min - 5 max)
+    PRIORITIES = {"error": "5", "fail": "5", "cancel": "4", "pause": "4", "progress": "2"}
+
+    def __init__(self, name, logger, topic, server="https://ntfy.sh", token=None, timeout=10):
+        Transport.__init__(self, name, logger, timeout)
+        self.url = server.rstrip("/") + "/" + quote(topic)
+        self.token = token
+
+    def _request(self, title, text, image, event_class):
+        headers = {
+            "Title": self._header(title),
+            "Priority": self.PRIORITIES.get(event_class, "3"),
+        }
+        if self.token:
+            headers["Authorization"] = "Bearer " + self.token
+        if image is None:
+            return self.session.post(
+                self.url, data=text.encode("utf-8"), headers=headers, timeout=self.timeout
+            )
+        # with an attachment the text has to go in a header, ntfy turns a literal \n into a line break
+        headers["Message"] = self._header(text.replace("\n", "\\n"))
+        headers["Filename"] = image[2]
+        return self.session.put(
+            self.url, data=image[0], headers=headers, timeout=self.timeout
+        )
+
+    @staticmethod
+    def _header(value):
+        try:
+            value.encode("ascii")
+            return value
+        except UnicodeEncodeError:
+            return Header(value, "utf-8").encode()
+
+
+class PushoverTransport(Transport):
+    PRIORITIES = {"error": 1, "fail": 1, "progress": -1, "upload": -1}
+
+    def __init__(
+        self,
+        name,
+        logger,
+        token,
+        user,
+        url="https://api.pushover.net/1/messages.json",
+        timeout=10,
+    ):
+        Transport.__init__(self, name, logger, timeout)
+        self.token = token
+        self.user = user
+        self.url = url
+
+    def _request(self, title, text, image, event_class):
+        data = {
+            "token": self.token,
+            "user": self.user,
+            "title": title,
+            "message": text or title,
+            "priority": self.PRIORITIES.get(event_class, 0),
+        }
+        files = None
+        if image is not None:
+            files = {"attachment": (image[2], image[0], image[1])}
+        return self.session.post(self.url, data=data, files=files, timeout=self.timeout)
+
+
+class MatrixTransport(Transport):
+    # pictures would need an upload to the media repository first, only the text is sent
+    _txn = itertools.count()
+
+    def __init__(self, name, logger, homeserver, room_id, access_token, timeout=10):
+        Transport.__init__(self, name, logger, timeout)
+        self.url = (
+            homeserver.rstrip("/")
+            + "/_matrix/client/v3/rooms/"
+            + quote(room_id, safe="")
+            + "/send/m.room.message/"
+        )
+        self.access_token = access_token
+
+    def _request(self, title, text, image, event_class):
+        # every event sent to a room needs its own transaction id
+        txn = f"octotext{int(time.time() * 1000)}.{next(self._txn)}"
+        return self.session.put(
+            self.url + txn,
+            json={"msgtype": "m.text", "body": f"{title}\n{text}" if text else title},
+            headers={"Authorization": "Bearer " + self.access_token},
+            timeout=self.timeout,
+        )
+
+
+TRANSPORT_TYPES = {
+    "webhook": WebhookTransport,
+    "ntfy": NtfyTransport,
+    "pushover": PushoverTransport,
+    "matrix": MatrixTransport,
+}
+
+
+def transports_from_settings(entries, logger):
+    """
+    :param entries: the "transports" setting, list of dicts with name, type and the arguments of the
+                    transport class (url, topic, token...). "events" is used by recipients.py and ignored here.
+    :param logger: broken entries are logged and skipped
+    :return: dict name -> Transport
+    """
+    transports = {}
+    for entry in entries or []:
+        try:
+            options = dict(entry)
+            name = options.pop("name")
+            kind = options.pop("type")
+            options.pop("events", None)
+            transports[name] = TRANSPORT_TYPES[kind](name, logger, **options)
+        except (KeyError, TypeError, ValueError) as e:
+            logger.warning(f"Ignoring transport {entry}: {e}")
+    return transports
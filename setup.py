@@ -58,7 +58,12 @@ plugin_ignored_packages = []
 # Example:
 #     plugin_requires = ["someDependency==dev"]
 #     additional_setup_parameters = {"dependency_links": ["https://github.com/someUser/someRepo/archive/master.zip#egg=someDependency-dev"]}
-additional_setup_parameters = {"python_requires": ">=3, <4"}
+additional_setup_parameters = {
+    "python_requires": ">=3, <4",
+    # optional: Pillow rotates/flips webcam snapshots in-process instead of starting ffmpeg, aiosmtplib is
+    # used by the asyncio delivery engine
+    "extras_require": {"pillow": ["Pillow"], "asyncio": ["aiosmtplib"]},
+}
 
 ########################################################################################################################
 